@@ -1,23 +1,95 @@
 from flask import Flask
+import click
 import os
 import json
 
 media_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'media_library'))
 progress_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '.', 'user_progress.json'))
+library_index_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '.', 'library_index.db'))
+jobs_db_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '.', 'jobs.db'))
+tmdb_cache_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '.', 'tmdb_cache.db'))
+state_db_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '.', 'state.db'))
+transcode_cache_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '.', 'transcode_cache'))
+subtitle_cache_path = os.path.abspath(os.path.join(os.path.dirname(__file__), '.', 'subtitle_cache'))
+
+# whether the app is being loaded for a flask cli command other than 'flask run', which serves it
+def _cli_command():
+    ctx = click.get_current_context(silent=True)
+    return ctx is not None and ctx.command.name != "run"
 
 def create_app():
     app = Flask(__name__)
-    default_secret = os.urandom(32)
-    app.secret_key = os.getenv("FLASK_SECRET_KEY", default_secret)
     app.config['MEDIA_PATH'] = media_path
     app.config['PROGRESS_PATH'] = progress_path
+    app.config['PROGRESS_JOURNAL_PATH'] = f"{progress_path}.journal"
+    app.config['LIBRARY_INDEX_PATH'] = library_index_path
+    app.config['JOBS_DB_PATH'] = jobs_db_path
+    app.config['TMDB_CACHE_PATH'] = tmdb_cache_path
+    app.config['STATE_DB_PATH'] = state_db_path
+    app.config['TRANSCODE_CACHE_PATH'] = transcode_cache_path
+    app.config['SUBTITLE_CACHE_PATH'] = subtitle_cache_path
+
+    from .state import state
+    state.init_app(app)
+
+    # job workers, the torrent poller, download monitor, library watcher and transcoder only run in processes serving
+    # the app, a cli command (or a bench server) would otherwise claim jobs from the real queue and exit holding them
+    app.config['BACKGROUND_WORKERS'] = os.getenv("BACKGROUND_WORKERS", "1") == "1" and not _cli_command()
+
+    # every worker has to sign sessions with the same key, so a generated one is shared through the state store
+    app.secret_key = os.getenv("FLASK_SECRET_KEY") or \
+        state.update("meta", "secret_key", lambda key: None if key else os.urandom(32).hex()) or \
+        state.get("meta", "secret_key")
 
     from .auth import identify_user
     app.before_request(identify_user)
 
-    from .routes import main, media, progress
+    from .library import library
+    library.init_app(app)
+
+    from .disk_usage import disk_usage
+    disk_usage.init_app(app)
+
+    from .tmdb import tmdb
+    tmdb.init_app(app)
+
+    from .progress_store import progress_store
+    progress_store.init_app(app)
+
+    from .torrent_poller import torrent_poller
+    torrent_poller.init_app(app)
+
+    from . import finalize
+    finalize.init_app(app)  # before the job queue picks interrupted post-processing back up
+
+    from .jobs import job_queue
+    from . import postprocess  # registers the post_process job
+    from .downloads import downloads  # registers the download job
+    job_queue.init_app(app)
+    downloads.init_app(app)
+
+    from .watcher import library_watcher
+    library_watcher.init_app(app)
+
+    from .transcoder import transcoder
+    transcoder.init_app(app)
+
+    from . import thumbnails
+    thumbnails.init_app(app)
+
+    from . import subtitles
+    subtitles.init_app(app)
+
+    from . import streaming
+    streaming.init_app(app)
+
+    from . import faststart
+    faststart.init_app(app)
+
+    from .routes import main, media, progress, transcode
     app.register_blueprint(main.bp)
     app.register_blueprint(media.bp)
     app.register_blueprint(progress.bp)
+    app.register_blueprint(transcode.bp)
 
     return app
@@ -0,0 +1,82 @@
+from dotenv import load_dotenv
+import threading
+import time
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+DISK_USAGE_INFLUX_TTL = float(os.getenv("DISK_USAGE_INFLUX_TTL", 30))  # seconds, for folders still downloading
+
+
+# depth-first walk of a folder using scandir, returning total bytes of all files inside it,
+# counting hardlinked files once (a finalized movie shares its data with the torrent's file)
+def folder_bytes(path):
+    total = 0
+    seen = set()   # (device, inode) of files with more than one link
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            st = entry.stat(follow_symlinks=False)
+                            if st.st_nlink > 1:
+                                if (st.st_dev, st.st_ino) in seen:
+                                    continue
+                                seen.add((st.st_dev, st.st_ino))
+                            total += st.st_size
+                    except OSError:
+                        continue  # file removed mid-walk
+        except OSError:
+            continue
+    return total
+
+
+# per-folder size cache for the media library: a finished movie folder is only re-walked when its mtime
+# changes or it is invalidated by an ingest/delete, folders still downloading are re-walked every so often
+class DiskUsage:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sizes = {}   # folder name -> (folder mtime, bytes, time computed)
+        self.media_path = None
+
+    def init_app(self, app):
+        self.media_path = app.config['MEDIA_PATH']
+
+    # forgets a folder's cached size, called whenever the app changes the folder
+    def invalidate(self, name):
+        with self.lock:
+            self.sizes.pop(name, None)
+
+    def _folder_size(self, name, mtime, force):
+        now = time.monotonic()
+        with self.lock:
+            cached = self.sizes.get(name)
+        if cached and not force and cached[0] == mtime:
+            finished = os.path.exists(os.path.join(self.media_path, name, "metadata.json"))
+            if finished or now - cached[2] < DISK_USAGE_INFLUX_TTL:
+                return cached[1]
+
+        size = folder_bytes(os.path.join(self.media_path, name))
+        with self.lock:
+            self.sizes[name] = (mtime, size, now)
+        return size
+
+    # returns (total bytes, [(folder name, bytes)]) for every folder in the library
+    def usage(self, force=False):
+        folders = []
+        with os.scandir(self.media_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    folders.append((entry.name, self._folder_size(entry.name, entry.stat().st_mtime, force)))
+
+        names = {name for name, _ in folders}
+        with self.lock:
+            for name in [n for n in self.sizes if n not in names]:
+                del self.sizes[name]
+        return sum(size for _, size in folders), folders
+
+
+disk_usage = DiskUsage()
@@ -0,0 +1,240 @@
+from .jobs import job_queue
+from .tmdb import tmdb
+from .jackett import jackett
+from .releases import rank_releases, release_queries, confident
+from .qbittorrent import qbittorrent
+from .torrent_poller import torrent_poller
+from .postprocess import enqueue_post_process, post_process_key
+from .state import state
+from flask import current_app
+from dotenv import load_dotenv
+import threading
+import shutil
+import time
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+DOWNLOAD_MONITOR_INTERVAL = float(os.getenv("DOWNLOAD_MONITOR_INTERVAL", 2))  # seconds between state checks
+ADDED_LOOKUP_ATTEMPTS = 5  # seconds a cancelled request's job waits for its just added torrent to show up
+
+# queued -> searching -> adding -> downloading -> post-processing -> ready, or failed from any of them
+STATES = ("queued", "searching", "adding", "downloading", "post-processing", "ready", "failed")
+REQUEST_STATES = ("queued", "searching", "adding")  # run by the download job
+ACTIVE_STATES = REQUEST_STATES + ("downloading", "post-processing")
+
+
+# job key for a movie's download request, one per tmdb id
+def download_key(tmdb_id):
+    return f"download:{tmdb_id}"
+
+
+# a movie request that can't succeed by retrying
+class DownloadFailed(Exception):
+    pass
+
+
+# download requests as a persistent state machine in the shared state store: the search and torrent add run on
+# the job queue's workers, a monitor thread moves requests through downloading -> post-processing -> ready from
+# the torrent poller and the post-processing job, and every transition is an atomic update conditional on the
+# current state, so several workers can't double it
+class DownloadTracker:
+    def __init__(self):
+        self.changed = threading.Condition()
+        self.version = 0
+        self.signature = None
+
+    def init_app(self, app):
+        self.media_path = app.config['MEDIA_PATH']
+        self.logger = app.logger
+        if app.config['BACKGROUND_WORKERS']:
+            threading.Thread(target=self._monitor_loop, name="download-monitor", daemon=True).start()
+
+    # returns a request as a dict given its tmdb id, None if the movie was never requested
+    def get(self, tmdb_id):
+        return state.get("downloads", str(tmdb_id))
+
+    # the request whose movie folder has given name, None if there's none
+    def for_title(self, title):
+        return next((d for d in state.items("downloads").values() if d["title"] == title), None)
+
+    def active(self):
+        return [d for d in state.items("downloads").values() if d["state"] in ACTIVE_STATES]
+
+    # requests a movie, queueing its download unless it's already on its way or in the library,
+    # returns the request's state
+    def request(self, tmdb_id, title=None):
+        current = {}
+
+        def queue(existing):
+            if existing and (existing["state"] in ACTIVE_STATES or existing["state"] == "ready" and existing["title"]
+                             and os.path.isdir(os.path.join(self.media_path, existing["title"]))):
+                current["state"] = existing["state"]  # as seen in the transaction, a cancel may remove it right after
+                return None
+            now = time.time()
+            return {"tmdb_id": tmdb_id, "title": title or (existing or {}).get("title"), "state": "queued",
+                    "progress": 0, "torrent_state": None, "error": None, "created": now, "updated": now}
+
+        if state.update("downloads", str(tmdb_id), queue) is None:
+            return current["state"]
+        job_queue.enqueue("download", download_key(tmdb_id), {"tmdb_id": tmdb_id})
+        self._notify()
+        return "queued"
+
+    # sets fields of a request if it's in one of from_states (any state if None), returns whether it was updated
+    def update(self, tmdb_id, from_states=None, **fields):
+        def apply(d):
+            if d is None or from_states and d["state"] not in from_states:
+                return None
+            return dict(d, **fields, updated=time.time())
+
+        updated = state.update("downloads", str(tmdb_id), apply) is not None
+        if updated:
+            self._notify()
+        return updated
+
+    # moves a request to a new state if it's in one of from_states, returns whether it moved
+    def transition(self, tmdb_id, to_state, from_states=None, **fields):
+        moved = self.update(tmdb_id, from_states, state=to_state, **fields)
+        if moved:
+            self.logger.info(f"Download {tmdb_id} -> {to_state}")
+        return moved
+
+    def fail(self, tmdb_id, error, from_states=ACTIVE_STATES):
+        return self.transition(tmdb_id, "failed", from_states, error=str(error)[:500])
+
+    # forgets a request, e.g. once it's cancelled, which also stops a queued download job from adding its torrent
+    def remove(self, tmdb_id):
+        state.delete("downloads", str(tmdb_id))
+        self._notify()
+
+    # forgets the request for a movie folder that's been deleted from the library
+    def remove_title(self, title):
+        d = self.for_title(title)
+        if d:
+            self.remove(d["tmdb_id"])
+
+    # blocks until something changed since given version or timeout passes, returns the current version
+    def wait_for_change(self, version, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def _notify(self):
+        with self.changed:
+            self.version += 1
+            self.changed.notify_all()
+
+    def _monitor_loop(self):
+        version = None
+        while True:
+            version = torrent_poller.wait_for_change(version, DOWNLOAD_MONITOR_INTERVAL)
+            try:
+                with state.lock("download-monitor", ttl=60, blocking=False) as acquired:
+                    if acquired:  # one worker at a time moves requests along, the others just watch for changes
+                        self._advance()
+                self._watch()
+            except Exception as e:
+                self.logger.warning(f"Failed to advance downloads: {e}")
+
+    # status of a request's job, None if it's left over from before the request last changed (a re-request)
+    def _job(self, key, d):
+        job = job_queue.status(key)
+        return job if job and job["updated"] >= d["updated"] else None
+
+    # moves active requests along from the torrent table and job statuses
+    def _advance(self):
+        for d in self.active():
+            tmdb_id, title, current = d["tmdb_id"], d["title"], d["state"]
+            if current in REQUEST_STATES:
+                job = self._job(download_key(tmdb_id), d)
+                if job and job["status"] == "failed":  # gave up after its retries
+                    self.fail(tmdb_id, job["last_error"], REQUEST_STATES)
+            elif current == "downloading":
+                torrent = torrent_poller.find(title, timeout=0)
+                if torrent is None:
+                    continue
+                progress = round(torrent["progress"], 3)
+                if progress >= 1.0:
+                    if self.transition(tmdb_id, "post-processing", ("downloading",), progress=1.0,
+                                       torrent_state=torrent["state"]):
+                        enqueue_post_process(tmdb_id, title, os.path.join(self.media_path, title))
+                elif (progress, torrent["state"]) != (d["progress"], d["torrent_state"]):
+                    self.update(tmdb_id, ("downloading",), progress=progress, torrent_state=torrent["state"])
+            elif current == "post-processing":
+                job = self._job(post_process_key(tmdb_id), d)
+                if job and job["status"] == "done":
+                    self.transition(tmdb_id, "ready", ("post-processing",))
+                elif job and job["status"] == "failed":
+                    self.fail(tmdb_id, job["last_error"], ("post-processing",))
+
+    # wakes up /events streams when another worker changed a request
+    def _watch(self):
+        signature = sorted((d["tmdb_id"], d["state"], d["progress"], d["torrent_state"])
+                           for d in state.items("downloads").values())
+        if signature != self.signature:
+            self.signature = signature
+            self._notify()
+
+
+downloads = DownloadTracker()
+
+
+# download job: looks the movie up, searches for the best release and adds it to qbittorrent,
+# safe to re-run, and a no-op once the request has moved on or been cancelled
+def run_download(job):
+    tmdb_id = job["tmdb_id"]
+    d = downloads.get(tmdb_id)
+    if d is None or d["state"] not in REQUEST_STATES:
+        return
+
+    downloads.transition(tmdb_id, "searching", REQUEST_STATES)
+    try:
+        movie = tmdb.movie(tmdb_id)
+        title = movie["title"]
+        downloads.update(tmdb_id, ("searching",), title=title)
+
+        # searches Jackett's indexers with the year, then without it, until some release passes the scoring engine,
+        # each search returns as soon as a confident pick has arrived
+        results, ranked = [], []
+        for query in release_queries(movie):
+            results = jackett.search(query, good_enough=lambda so_far: confident(so_far, movie))
+            ranked, rejected = rank_releases(results, movie)
+            current_app.logger.info(f"'{query}': {len(results)} results, {len(ranked)} acceptable, rejected by {rejected}")
+            if ranked:
+                break
+        if not results:
+            raise DownloadFailed("No torrents found")
+        if not ranked:
+            raise DownloadFailed("No acceptable torrents found")
+    except DownloadFailed as e:
+        downloads.fail(tmdb_id, e, ("searching",))
+        return
+
+    score, best, scores = ranked[0]
+    current_app.logger.info(f"Picked '{best['Title']}' with score {score:.2f} {({k: round(v, 2) for k, v in scores.items()})}")
+    if not downloads.transition(tmdb_id, "adding", ("searching",)):
+        return  # cancelled while searching
+
+    save_path = os.path.join(current_app.config['MEDIA_PATH'], title)
+    os.makedirs(save_path, exist_ok=True)
+    qbittorrent.add_torrent(best.get("MagnetUri") or best["Link"], save_path)
+    if not downloads.transition(tmdb_id, "downloading", ("adding",)):
+        # cancelled while adding, before the poller could have shown the route the new torrent
+        current_app.logger.info(f"Download {tmdb_id} was cancelled while adding, removing its torrent")
+        _discard_added(save_path)
+
+
+# removes the torrent a cancelled request's job just added, and the folder it was saving into,
+# qBittorrent adds magnets asynchronously so it can take a moment to show up
+def _discard_added(save_path):
+    for _ in range(ADDED_LOOKUP_ATTEMPTS):
+        hashes = [t["hash"] for t in qbittorrent.torrents_info(category="media")
+                  if os.path.normpath(t.get("save_path", "")) == os.path.normpath(save_path)]
+        if hashes:
+            qbittorrent.delete_torrents(hashes, delete_files=True)
+            break
+        time.sleep(1)
+    shutil.rmtree(save_path, ignore_errors=True)
+
+
+job_queue.register("download", run_download)
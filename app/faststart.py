@@ -0,0 +1,220 @@
+from .streaming import top_level_boxes, MP4_EXTENSIONS
+from .packaging import find_movie_file
+from .probe import probe
+from flask import current_app
+from dotenv import load_dotenv
+import subprocess
+import shutil
+import click
+import time
+import json
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+FASTSTART = os.getenv("FASTSTART", "1") == "1"   # move a trailing moov atom to the front of mp4s during ingest
+COPY_CHUNK = 8 * 1024 * 1024
+MOOV_PATH = (b"moov", b"trak", b"mdia", b"minf", b"stbl")  # boxes holding the chunk offset tables
+
+
+# where an mp4's moov atom is relative to its media data: "front", "end", or None if it isn't a plain mp4
+# (no moov/mdat, or a fragmented one, which is streamable as it is)
+def moov_position(path):
+    if not path.lower().endswith(MP4_EXTENSIONS):
+        return None
+    with open(path, "rb") as f:
+        boxes = {}
+        for box, offset, size in top_level_boxes(f.fileno(), os.fstat(f.fileno()).st_size):
+            boxes.setdefault(box, (offset, size))
+    if "moov" not in boxes or "mdat" not in boxes or "moof" in boxes:
+        return None
+    return "front" if boxes["moov"][0] < boxes["mdat"][0] else "end"
+
+
+# shifts every chunk offset (stco/co64 entries) in a moov atom by shift(offset), in place,
+# raises OverflowError if a 32-bit stco entry no longer fits, ValueError if the atom is malformed
+def _patch_offsets(moov, start, end, shift):
+    pos = start
+    while pos + 8 <= end:
+        size, box, header = int.from_bytes(moov[pos:pos + 4], "big"), bytes(moov[pos + 4:pos + 8]), 8
+        if size == 1:
+            size, header = int.from_bytes(moov[pos + 8:pos + 16], "big"), 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise ValueError(f"malformed {box!r} box")
+        if box in MOOV_PATH:
+            _patch_offsets(moov, pos + header, pos + size, shift)
+        elif box in (b"stco", b"co64"):
+            width = 4 if box == b"stco" else 8
+            count = int.from_bytes(moov[pos + header + 4:pos + header + 8], "big")
+            entry = pos + header + 8
+            if entry + count * width > pos + size:
+                raise ValueError(f"truncated {box!r} box")
+            for i in range(entry, entry + count * width, width):
+                moov[i:i + width] = shift(int.from_bytes(moov[i:i + width], "big")).to_bytes(width, "big")
+        pos += size
+
+
+# copies length bytes of src from src_offset to the end of dst, in the kernel where it can
+def _copy_range(src, dst, src_offset, length):
+    while length > 0:
+        try:
+            copied = os.copy_file_range(src, dst, min(length, 1 << 30), src_offset)
+        except (AttributeError, OSError):  # older python/kernel, or across filesystems
+            chunk = os.pread(src, min(length, COPY_CHUNK), src_offset)
+            copied = os.write(dst, chunk)
+        if not copied:
+            raise OSError(f"unexpected end of file at {src_offset}")
+        src_offset += copied
+        length -= copied
+
+
+# writes path's boxes to tmp with the moov atom moved in front of the media data, patching its chunk offsets,
+# one sequential pass and no re-encoding, returns the moov size
+def _rewrite(path, tmp):
+    with open(path, "rb") as f:
+        fd = f.fileno()
+        size = os.fstat(fd).st_size
+        boxes = list(top_level_boxes(fd, size))
+        moov_offset, moov_size = next((offset, n) for box, offset, n in boxes if box == "moov")
+        mdat_offset = next(offset for box, offset, _ in boxes if box == "mdat")
+
+        moov = bytearray(os.pread(fd, moov_size, moov_offset))
+        # data between the first mdat and the old moov moves down by the moov's size, anything after stays put
+        _patch_offsets(moov, 0, len(moov), lambda offset: offset + moov_size if mdat_offset <= offset < moov_offset else offset)
+        with open(tmp, "wb", buffering=0) as out:  # unbuffered, the copies write at the file's position too
+            _copy_range(fd, out.fileno(), 0, mdat_offset)
+            out.write(moov)
+            _copy_range(fd, out.fileno(), mdat_offset, moov_offset - mdat_offset)
+            _copy_range(fd, out.fileno(), moov_offset + moov_size, size - moov_offset - moov_size)
+            os.fsync(out.fileno())
+    return moov_size
+
+
+# same through ffmpeg, for layouts the native rewrite can't patch (offsets past 4GB in a 32-bit stco table)
+def _rewrite_ffmpeg(path, tmp):
+    subprocess.run(["ffmpeg", "-y", "-v", "error", "-i", path, "-map", "0", "-c", "copy", "-movflags", "+faststart",
+                    "-f", "mp4", tmp], check=True)
+
+
+# moves a trailing moov atom to the front of an mp4 so playback can start without a seek to the end of the file,
+# safe to re-run: a file already in that layout (or not an mp4) is left alone, and so is a file hardlinked elsewhere
+# (a torrent still seeding it) unless linked, since the rewrite goes to a new file and would double its disk use,
+# its moov is served from the hot ranges instead,
+# returns {status: "rewritten" | "already" | "linked" | "skipped", method, moov_bytes, seconds}
+def faststart(path, linked=False):
+    start = time.monotonic()
+    tmp = f"{path}.faststart"
+    if os.path.exists(tmp):
+        os.remove(tmp)  # left over from a crash mid-rewrite
+    position = moov_position(path)
+    if position == "end" and not linked and os.stat(path).st_nlink > 1:
+        position = "linked"
+    if position != "end":
+        status = {"front": "already", "linked": "linked"}.get(position, "skipped")
+        return {"status": status, "method": None, "moov_bytes": None, "seconds": 0}
+
+    try:
+        try:
+            moov_bytes, method = _rewrite(path, tmp), "native"
+        except (OverflowError, ValueError) as e:
+            current_app.logger.warning(f"Can't rewrite {path} natively ({e}), using ffmpeg")
+            _rewrite_ffmpeg(path, tmp)
+            moov_bytes, method = None, "ffmpeg"
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    shutil.copymode(path, tmp)  # not the times: a new mtime is what tells caches (etags, hot ranges) the bytes moved
+    os.replace(tmp, path)
+    result = {"status": "rewritten", "method": method, "moov_bytes": moov_bytes,
+              "seconds": round(time.monotonic() - start, 2)}
+    current_app.logger.info(f"Moved moov of {path} to the front: {result}")
+    return result
+
+
+# simulates a progressive player against a media url: reads the start of the file, walks its top-level boxes
+# (seeking past the mdat when the moov comes after it) until it has the whole moov and the first media bytes,
+# returns (milliseconds, range requests made)
+def time_to_first_frame(client, url, size, probe_bytes=256 * 1024):
+    start = time.perf_counter()
+    requests = 0
+    head = b""
+
+    def read(offset, length):
+        nonlocal requests
+        if offset + length <= len(head):
+            return head[offset:offset + length]
+        requests += 1
+        end = min(offset + max(length, probe_bytes), size) - 1
+        return client.get(url, headers={"Range": f"bytes={offset}-{end}"}).data[:length]
+
+    head = read(0, probe_bytes)
+    offset, moov, mdat = 0, False, None
+    while offset + 8 <= size and not (moov and mdat is not None):
+        header = read(offset, 16)
+        box_size, box = int.from_bytes(header[:4], "big"), header[4:8]
+        if box_size == 1:
+            box_size = int.from_bytes(header[8:16], "big")
+        elif box_size == 0:
+            box_size = size - offset
+        if box_size < 8:
+            break
+        if box == b"moov":
+            read(offset, box_size)
+            moov = True
+        elif box == b"mdat" and mdat is None:
+            mdat = offset
+        offset += box_size
+    if mdat is not None:
+        read(mdat + 8, probe_bytes)
+    return (time.perf_counter() - start) * 1000, requests
+
+
+def init_app(app):
+    # flask faststart [movie] [--bench] [--linked], moves trailing moov atoms to the front for one movie or the whole
+    # library, recording it in metadata.json, --bench times the first frame of a simulated player before and after
+    @app.cli.command("faststart")
+    @click.argument("movie", required=False)
+    @click.option("--bench", is_flag=True, help="Time to first frame before and after.")
+    @click.option("--linked", is_flag=True, help="Rewrite files still hardlinked to a torrent too, copying them.")
+    def faststart_command(movie, bench, linked):
+        from .library import library
+        media_path = app.config['MEDIA_PATH']
+        client = app.test_client()
+        for name in [movie] if movie else sorted(os.listdir(media_path)):
+            base_path = os.path.join(media_path, name)
+            path = find_movie_file(base_path) if os.path.isdir(base_path) else None
+            if path is None:
+                continue
+            url = f"/media/{name}/{os.path.basename(path)}"
+            before = time_to_first_frame(client, url, os.path.getsize(path)) if bench else None
+            try:
+                result = faststart(path, linked)
+            except (OSError, subprocess.CalledProcessError) as e:
+                click.echo(f"Failed to rewrite {name}: {e}", err=True)
+                continue
+            line = f"{name}: {result['status']}"
+            if bench:
+                after = time_to_first_frame(client, url, os.path.getsize(path))
+                line += f", first frame {before[0]:.1f}ms/{before[1]} requests -> {after[0]:.1f}ms/{after[1]} requests"
+            click.echo(line)
+
+            metadata_path = os.path.join(base_path, "metadata.json")
+            if result["status"] != "skipped" and os.path.exists(metadata_path):
+                with open(metadata_path, encoding="utf-8") as f:
+                    metadata = json.load(f)
+                if result["status"] == "already" and "faststart" in (metadata.get("media") or {}):
+                    continue  # keep the record of how it got that way
+                media = metadata.get("media")
+                if not media:
+                    try:
+                        media = probe(path)
+                    except (OSError, subprocess.CalledProcessError, ValueError):
+                        media = {}
+                metadata["media"] = dict(media, faststart=result)
+                tmp_path = f"{metadata_path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(metadata, f, ensure_ascii=False, indent=4)
+                os.replace(tmp_path, metadata_path)
+                library.refresh(name)
@@ -0,0 +1,151 @@
+from .library import library
+from .disk_usage import disk_usage
+from .state import state
+from .jobs import pid_alive
+from .thumbnails import THUMBNAIL_DIR
+from .probe import pick_main_feature
+from flask import current_app
+from dotenv import load_dotenv
+import shutil
+import time
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+FINALIZE_MODE = os.getenv("FINALIZE_MODE", "hardlink")  # hardlink: keeps the torrent seeding | move: takes its file
+VIDEO_EXTENSIONS = (".mp4", ".mkv", ".avi", ".mov")
+APP_DIRS = {"hls", THUMBNAIL_DIR}  # folders the app itself writes into a movie folder
+COPY_CHUNK = 8 * 1024 * 1024
+
+
+# bytes this thread has read from/written to storage so far, None where /proc doesn't say
+def _io_counters():
+    try:
+        with open("/proc/thread-self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["read_bytes"]), int(fields["write_bytes"])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+# video files of the torrent's payload in a movie folder
+def _videos(base_path):
+    videos = []
+    for root, dirs, files in os.walk(base_path):
+        if root == base_path:
+            dirs[:] = [d for d in dirs if d not in APP_DIRS]
+            files = [f for f in files if not f.startswith("movie.")]
+        videos += [os.path.join(root, file) for file in files if file.lower().endswith(VIDEO_EXTENSIONS)]
+    return videos
+
+
+# copies src to dst, synced to disk, returns bytes copied
+def _copy(src, dst):
+    copied = 0
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        while True:
+            chunk = fsrc.read(COPY_CHUNK)
+            if not chunk:
+                break
+            fdst.write(chunk)
+            copied += len(chunk)
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    shutil.copystat(src, dst)
+    return copied
+
+
+# puts src's content at dst without copying where the filesystem allows it,
+# returns (how: "hardlink" | "rename" | "copy", bytes copied)
+def _place(src, dst, mode):
+    try:
+        if mode == "move":
+            os.rename(src, dst)
+            return "rename", 0
+        os.link(src, dst)
+        return "hardlink", 0
+    except OSError as e:  # another filesystem (EXDEV) or one without hardlinks
+        current_app.logger.warning(f"Can't {mode} {src} in place ({e}), copying it")
+    copied = _copy(src, dst)
+    if mode == "move":
+        os.remove(src)  # only once the copy is complete and synced
+    return "copy", copied
+
+
+# makes the payload's main feature (by duration against tmdb's runtime in minutes, see probe.pick_main_feature) the
+# folder's movie.{ext}, by default hardlinking it so the torrent keeps seeding from where qBittorrent put it,
+# an intent recorded in the state store first lets recover() finish or undo it after a crash,
+# returns what it did ({mode, method, bytes, copied, io_read, io_write}) or False if there's nothing to do
+def finalize_movie_folder(base_path, mode=None, runtime=None):
+    mode = mode or FINALIZE_MODE
+    src = pick_main_feature(_videos(base_path), runtime)
+    if src is None:
+        current_app.logger.warning(f"No video files found in {base_path}")
+        return False
+
+    dst = os.path.join(base_path, f"movie{os.path.splitext(src)[1].lower()}")
+    top = os.path.relpath(src, base_path).split(os.sep, 1)[0]
+    payload = os.path.join(base_path, top) if top != os.path.basename(src) else None  # torrent's folder, if any
+    intent = {"src": src, "dst": dst, "tmp": f"{dst}.finalizing", "mode": mode, "payload": payload,
+              "pid": os.getpid(), "started": time.time()}
+    state.set("finalize", base_path, intent)
+
+    before = _io_counters()
+    try:
+        method, copied = _place(src, intent["tmp"], mode)
+        os.replace(intent["tmp"], dst)
+        if mode == "move" and payload:
+            shutil.rmtree(payload)
+    except Exception:
+        _roll_back(intent)
+        state.delete("finalize", base_path)
+        raise
+    state.delete("finalize", base_path)
+    after = _io_counters()
+
+    result = {
+        "mode": mode,
+        "method": method,
+        "bytes": os.path.getsize(dst),
+        "copied": copied,
+        "io_read": after[0] - before[0] if before and after else None,
+        "io_write": after[1] - before[1] if before and after else None
+    }
+    current_app.logger.info(f"Finalized {src} as {dst}: {result}")
+    library.refresh(os.path.basename(base_path))
+    disk_usage.invalidate(os.path.basename(base_path))
+    return result
+
+
+# undoes a half-done finalize: puts a moved file back, or drops a partial copy/extra link
+def _roll_back(intent):
+    tmp, src = intent["tmp"], intent["src"]
+    if not os.path.exists(tmp):
+        return
+    if os.path.exists(src):
+        os.remove(tmp)
+    else:
+        os.rename(tmp, src)
+
+
+# settles finalizes interrupted by a crash: ones that got as far as movie.{ext} are finished, the rest rolled back
+# (their post-processing job runs again and redoes them), skipping any a still running worker is in the middle of
+def recover():
+    with state.lock("finalize-recovery"):
+        for base_path, intent in state.items("finalize").items():
+            if pid_alive(intent["pid"]):
+                continue
+            if os.path.exists(intent["dst"]):
+                if os.path.exists(intent["tmp"]):
+                    os.remove(intent["tmp"])
+                if intent["mode"] == "move" and intent["payload"] and os.path.exists(intent["payload"]):
+                    shutil.rmtree(intent["payload"])
+                current_app.logger.info(f"Resumed interrupted finalize of {base_path}")
+            else:
+                _roll_back(intent)
+                current_app.logger.info(f"Rolled back interrupted finalize of {base_path}")
+            state.delete("finalize", base_path)
+
+
+def init_app(app):
+    with app.app_context():
+        recover()
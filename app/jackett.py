@@ -0,0 +1,182 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from xml.etree import ElementTree
+from dotenv import load_dotenv
+import threading
+import requests
+import time
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+JACKETT_API_KEY = os.getenv("JACKETT_API_KEY")
+JACKETT_URL = os.getenv("JACKETT_URL", "http://localhost:9117")
+JACKETT_INDEXERS = [i.strip() for i in os.getenv("JACKETT_INDEXERS", "").split(",") if i.strip()]  # empty = all configured
+JACKETT_DEADLINE = float(os.getenv("JACKETT_DEADLINE", 12))           # seconds for a whole search
+JACKETT_CACHE_TTL = int(os.getenv("JACKETT_CACHE_TTL", 600))          # seconds a query's results are reused for
+JACKETT_SLOW_SECONDS = float(os.getenv("JACKETT_SLOW_SECONDS", 8))    # average latency that gets an indexer skipped
+JACKETT_MAX_FAILURES = int(os.getenv("JACKETT_MAX_FAILURES", 3))      # consecutive failures that get it skipped
+JACKETT_SKIP_SECONDS = int(os.getenv("JACKETT_SKIP_SECONDS", 600))    # how long it's skipped for, then it's retried
+INDEXER_LIST_TTL = 3600
+LATENCY_SMOOTHING = 0.3  # weight of the newest sample in an indexer's average latency
+TORZNAB_NS = "{http://torznab.com/schemas/2015/feed}"
+
+
+# parses a torznab rss feed into results shaped like jackett's json api results
+def parse_torznab(xml, indexer):
+    root = ElementTree.fromstring(xml)
+    if root.tag == "error":
+        raise ValueError(f"{indexer}: {root.get('description')}")
+
+    results = []
+    for item in root.iter("item"):
+        attrs = {attr.get("name"): attr.get("value") for attr in item.iter(f"{TORZNAB_NS}attr")}
+        enclosure = item.find("enclosure")
+        link = item.findtext("link") or (enclosure.get("url") if enclosure is not None else None)
+        results.append({
+            "Title": item.findtext("title") or "",
+            "Tracker": indexer,
+            "Size": int(item.findtext("size") or attrs.get("size") or 0),
+            "Seeders": int(attrs.get("seeders") or 0),
+            "Peers": int(attrs.get("peers") or 0),
+            "MagnetUri": attrs.get("magneturl") or (link if link and link.startswith("magnet:") else None),
+            "Link": link
+        })
+    return results
+
+
+# short description of a failed request, without its url (which carries the api key)
+def _describe(error):
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return f"HTTP {error.response.status_code}"
+    if isinstance(error, requests.RequestException):
+        return type(error).__name__
+    return str(error)[:200]
+
+
+# latency/failure record of one indexer
+class _IndexerStats:
+    def __init__(self):
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.avg_latency = None
+        self.last_error = None
+        self.skipped_until = 0
+
+    def as_dict(self):
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "consecutive_failures": self.consecutive_failures,
+            "avg_latency": round(self.avg_latency, 2) if self.avg_latency is not None else None,
+            "last_error": self.last_error,
+            "skipped": self.skipped_until > time.monotonic()
+        }
+
+
+# torrent search through jackett: every configured indexer is queried concurrently through its own torznab
+# endpoint within one overall deadline, returning early once the caller is happy with what has arrived,
+# indexers that keep failing or are persistently slow are skipped for a while, and results are cached per query
+class JackettClient:
+    def __init__(self, url, api_key, indexers=None):
+        self.url = url.rstrip("/")
+        self.api_key = api_key
+        self.indexers = indexers or []
+        self.lock = threading.Lock()
+        self.cache = {}        # normalised query -> (expires, results)
+        self.stats = {}        # indexer id -> _IndexerStats
+        self.discovered = (0, [])  # (expires, configured indexer ids), when JACKETT_INDEXERS isn't set
+        self.pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="jackett")
+
+    # configured indexer ids, from JACKETT_INDEXERS or asked of jackett
+    def configured_indexers(self):
+        if self.indexers:
+            return self.indexers
+        expires, indexers = self.discovered
+        if expires > time.monotonic():
+            return indexers
+        r = requests.get(f"{self.url}/api/v2.0/indexers/all/results/torznab/api",
+                         params={"apikey": self.api_key, "t": "indexers", "configured": "true"}, timeout=JACKETT_DEADLINE)
+        r.raise_for_status()
+        indexers = [i.get("id") for i in ElementTree.fromstring(r.content).iter("indexer")]
+        self.discovered = (time.monotonic() + INDEXER_LIST_TTL, indexers)
+        return indexers
+
+    # indexers worth asking right now, skipped ones come back (for one more try) once their skip runs out
+    def _active_indexers(self):
+        indexers = self.configured_indexers()
+        now = time.monotonic()
+        with self.lock:
+            return [i for i in indexers if self.stats.setdefault(i, _IndexerStats()).skipped_until <= now]
+
+    # queries one indexer, recording its latency or failure, runs on the pool so it's recorded even after a cut-off
+    def _search_indexer(self, indexer, query):
+        start = time.monotonic()
+        try:
+            r = requests.get(f"{self.url}/api/v2.0/indexers/{indexer}/results/torznab/api",
+                             params={"apikey": self.api_key, "t": "search", "q": query}, timeout=JACKETT_DEADLINE)
+            r.raise_for_status()
+            results = parse_torznab(r.content, indexer)
+        except (requests.RequestException, ElementTree.ParseError, ValueError) as e:
+            self._record(indexer, time.monotonic() - start, e)
+            raise
+        self._record(indexer, time.monotonic() - start)
+        return results
+
+    def _record(self, indexer, latency, error=None):
+        with self.lock:
+            s = self.stats.setdefault(indexer, _IndexerStats())
+            probe = s.skipped_until != 0  # first request since coming back from a skip
+            s.requests += 1
+            s.avg_latency = latency if s.avg_latency is None or probe else \
+                LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * s.avg_latency
+            if error is None:
+                s.consecutive_failures = 0
+            else:
+                s.failures += 1
+                s.consecutive_failures += 1
+                s.last_error = _describe(error)
+            s.skipped_until = 0
+            if s.consecutive_failures >= JACKETT_MAX_FAILURES or s.avg_latency > JACKETT_SLOW_SECONDS:
+                s.skipped_until = time.monotonic() + JACKETT_SKIP_SECONDS
+
+    # returns results for a query from every active indexer that answers within the deadline, or as soon as
+    # good_enough(results so far) is true (the rest finish in the background),
+    # only complete answers are cached, raises requests.RequestException if no indexer answered
+    def search(self, query, good_enough=None):
+        key = " ".join(query.lower().split())
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached and cached[0] > now:
+                return cached[1]
+
+        indexers = self._active_indexers()
+        if not indexers:
+            raise requests.RequestException("No Jackett indexers available")
+        pending = {self.pool.submit(self._search_indexer, indexer, query) for indexer in indexers}
+        deadline = now + JACKETT_DEADLINE
+        results, answered = [], 0
+        while pending and time.monotonic() < deadline:
+            done, pending = wait(pending, timeout=deadline - time.monotonic(), return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    results += future.result()
+                    answered += 1
+            if good_enough and results and good_enough(results):
+                break
+        if not answered:
+            raise requests.RequestException(f"No Jackett indexer answered '{query}' in time" if pending
+                                            else f"Every Jackett indexer failed for '{query}'")
+
+        if not pending and answered == len(indexers):  # a cut-off or partial answer isn't worth reusing
+            with self.lock:
+                self.cache = {k: v for k, v in self.cache.items() if v[0] > now}  # drop expired queries
+                self.cache[key] = (now + JACKETT_CACHE_TTL, results)
+        return results
+
+    def indexer_stats(self):
+        with self.lock:
+            return {indexer: s.as_dict() for indexer, s in self.stats.items()}
+
+
+jackett = JackettClient(JACKETT_URL, JACKETT_API_KEY, JACKETT_INDEXERS)
@@ -0,0 +1,163 @@
+from dotenv import load_dotenv
+import threading
+import sqlite3
+import json
+import time
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 4))
+JOB_RETRY_BACKOFF = float(os.getenv("JOB_RETRY_BACKOFF", 30))  # seconds, doubled after every failed attempt
+
+
+# whether the process with given pid is still running
+def pid_alive(pid):
+    if not pid or pid == os.getpid():
+        return False  # a job can't be running in this process yet, it's only just starting
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+# persistent background job queue backed by sqlite: jobs are keyed so enqueueing work that is already
+# pending is a no-op, run on a small worker pool inside an app context, and retried with exponential backoff
+class JobQueue:
+    def __init__(self):
+        self.handlers = {}   # kind -> function taking the job's payload
+        self.dedicated = {}  # kind -> number of workers of its own, its jobs stay off the shared pool
+        self.wakeup = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+        self.db_path = app.config['JOBS_DB_PATH']
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")  # gunicorn workers share the queue, readers shouldn't wait on claims
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                key TEXT PRIMARY KEY, kind TEXT, payload TEXT, status TEXT, attempts INTEGER DEFAULT 0,
+                run_after REAL, last_error TEXT, created REAL, updated REAL, owner INTEGER)""")
+            if "owner" not in [column[1] for column in db.execute("PRAGMA table_info(jobs)")]:
+                db.execute("ALTER TABLE jobs ADD COLUMN owner INTEGER")
+            self._requeue_orphaned(db)
+        if not app.config['BACKGROUND_WORKERS']:
+            return  # jobs can still be queued from here, serving processes run them
+        for i in range(JOB_WORKERS):
+            threading.Thread(target=self._work_loop, name=f"job-worker-{i}", daemon=True).start()
+        for kind, workers in self.dedicated.items():
+            for i in range(workers):
+                threading.Thread(target=self._work_loop, args=(kind,), name=f"job-worker-{kind}-{i}", daemon=True).start()
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    # workers gives the kind that many workers of its own (in every process), for long jobs that would otherwise
+    # hold up everything queued behind them
+    def register(self, kind, handler, workers=None):
+        self.handlers[kind] = handler
+        if workers:
+            self.dedicated[kind] = workers
+
+    # queues a job unless one with the same key is already queued/running, returns whether it was queued
+    def enqueue(self, kind, key, payload):
+        now = time.time()
+        with self._connect() as db:
+            cur = db.execute(
+                """INSERT INTO jobs (key, kind, payload, status, run_after, created, updated) VALUES (?, ?, ?, 'queued', ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET payload = excluded.payload, status = 'queued', attempts = 0,
+                run_after = excluded.run_after, last_error = NULL, updated = excluded.updated
+                WHERE jobs.status IN ('done', 'failed')""",
+                (key, kind, json.dumps(payload), now, now, now)
+            )
+        if cur.rowcount:
+            self.wakeup.set()
+        return bool(cur.rowcount)
+
+    # returns job state given its key, None if no such job
+    def status(self, key):
+        with self._connect() as db:
+            row = db.execute("SELECT kind, status, attempts, run_after, last_error, created, updated FROM jobs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        kind, status, attempts, run_after, last_error, created, updated = row
+        return {"key": key, "kind": kind, "status": status, "attempts": attempts, "run_after": run_after,
+                "last_error": last_error, "created": created, "updated": updated}
+
+    # jobs left running by a crash, restart or a process that exited mid-job get picked up again, but not ones another
+    # worker is running, nor (when claiming) ones this process is
+    def _requeue_orphaned(self, db, claiming=False):
+        for key, owner in db.execute("SELECT key, owner FROM jobs WHERE status = 'running'").fetchall():
+            if claiming and owner == os.getpid() or pid_alive(owner):
+                continue
+            db.execute("UPDATE jobs SET status = 'queued' WHERE key = ? AND status = 'running'", (key,))
+            self.app.logger.warning(f"Re-queued job {key}, the process running it ({owner}) is gone")
+
+    # atomically marks the next due job of given kind (None: of any kind without workers of its own) as running,
+    # after re-queueing any whose process died, returning (key, kind, payload, attempts)
+    def _claim(self, kind=None):
+        if kind is None:
+            kinds = list(self.dedicated)
+            where = f"kind NOT IN ({', '.join('?' * len(kinds))})"
+        else:
+            kinds = [kind]
+            where = "kind = ?"
+        db = self._connect()
+        try:
+            db.isolation_level = None
+            db.execute("BEGIN IMMEDIATE")
+            self._requeue_orphaned(db, claiming=True)
+            row = db.execute(
+                f"SELECT key, kind, payload, attempts FROM jobs WHERE status = 'queued' AND run_after <= ? AND {where} ORDER BY created LIMIT 1",
+                (time.time(), *kinds)
+            ).fetchone()
+            if row:
+                db.execute("UPDATE jobs SET status = 'running', owner = ?, updated = ? WHERE key = ?",
+                           (os.getpid(), time.time(), row[0]))
+            db.execute("COMMIT")
+        finally:
+            db.close()
+        return row
+
+    def _finish(self, key, attempts, error=None):
+        now = time.time()
+        with self._connect() as db:
+            if error is None:
+                db.execute("UPDATE jobs SET status = 'done', attempts = ?, last_error = NULL, updated = ? WHERE key = ?",
+                           (attempts, now, key))
+            elif attempts < JOB_MAX_ATTEMPTS:
+                run_after = now + JOB_RETRY_BACKOFF * 2 ** (attempts - 1)
+                db.execute("UPDATE jobs SET status = 'queued', attempts = ?, run_after = ?, last_error = ?, updated = ? WHERE key = ?",
+                           (attempts, run_after, error, now, key))
+            else:
+                db.execute("UPDATE jobs SET status = 'failed', attempts = ?, last_error = ?, updated = ? WHERE key = ?",
+                           (attempts, error, now, key))
+
+    def _work_loop(self, kind=None):
+        while True:
+            try:
+                job = self._claim(kind)
+            except sqlite3.Error as e:
+                self.app.logger.error(f"Failed to claim job: {e}")
+                job = None
+            if job is None:
+                self.wakeup.wait(1)
+                self.wakeup.clear()
+                continue
+
+            key, kind, payload, attempts = job
+            attempts += 1
+            try:
+                with self.app.app_context():
+                    self.handlers[kind](json.loads(payload))
+            except Exception as e:
+                self.app.logger.error(f"Job {key} failed (attempt {attempts}): {e}")
+                self._finish(key, attempts, error=str(e))
+            else:
+                self.app.logger.info(f"Job {key} done")
+                self._finish(key, attempts)
+
+
+job_queue = JobQueue()
@@ -0,0 +1,180 @@
+from .thumbnails import poster_srcsets, thumbnail_url
+from urllib.parse import quote
+import threading
+import sqlite3
+import html
+import json
+import time
+import os
+
+LIBRARY_RESCAN_INTERVAL = 60  # seconds between full mtime sweeps of every movie folder
+SNAPSHOT_VERSION = 2          # bumped whenever movie_info changes shape, older snapshots are rebuilt
+
+
+# builds the info shown on the homepage for a movie, given its folder name and metadata,
+# the poster is its largest jpeg thumbnail when it has thumbnails
+def movie_info(name, metadata):
+    thumbnails = metadata.get("poster_thumbnails")
+    return {
+        "name": name,
+        "encoded_name": html.escape(name, quote=True).replace("&#x27;", "&#39;"),
+        "poster": thumbnail_url(name, thumbnails, thumbnails["widths"][-1], "jpg") if thumbnails else f"/media/{quote(name)}/poster.jpg",
+        "poster_srcsets": poster_srcsets(name, thumbnails),
+        "title": metadata.get("title", name),
+        "year": (metadata.get("release_date") or "")[:4],
+        "overview": metadata.get("overview", "No description available."),
+        "genres": metadata.get("genres", []),
+        "runtime": metadata.get("runtime"),
+        "rating": metadata.get("rating"),
+        "tmdb_id": metadata.get("tmdb_id"),
+        "media": metadata.get("media")   # probe summary of the movie file, None for movies from before probing
+    }
+
+
+# returns mtime of given path, or None if it doesn't exist
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+# in-memory catalogue of the media library, backed by a sqlite snapshot so restarts don't re-read every metadata.json
+class LibraryIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.movies = {}   # folder name -> movie info
+        self.mtimes = {}   # folder name -> (folder mtime, metadata.json mtime)
+        self.media_path = None
+        self.db_path = None
+        self.root_mtime = None
+        self.last_sweep = 0
+
+    def init_app(self, app):
+        self.media_path = app.config['MEDIA_PATH']
+        self.db_path = app.config['LIBRARY_INDEX_PATH']
+        self.logger = app.logger
+        self._load_snapshot()
+        self.revalidate(force=True)
+
+    def _connect(self):
+        db = sqlite3.connect(self.db_path)
+        db.execute("CREATE TABLE IF NOT EXISTS movies (name TEXT PRIMARY KEY, dir_mtime REAL, meta_mtime REAL, info TEXT)")
+        if db.execute("PRAGMA user_version").fetchone()[0] != SNAPSHOT_VERSION:
+            with db:
+                db.execute("DELETE FROM movies")
+                db.execute(f"PRAGMA user_version = {SNAPSHOT_VERSION}")
+        return db
+
+    # loads the last known catalogue from disk
+    def _load_snapshot(self):
+        try:
+            with self._connect() as db:
+                rows = db.execute("SELECT name, dir_mtime, meta_mtime, info FROM movies").fetchall()
+        except sqlite3.Error as e:
+            self.logger.warning(f"Failed to load library snapshot: {e}")
+            return
+        with self.lock:
+            for name, dir_mtime, meta_mtime, info in rows:
+                self.movies[name] = json.loads(info)
+                self.mtimes[name] = (dir_mtime, meta_mtime)
+
+    # writes changed/removed folders to the snapshot
+    def _save_snapshot(self, changed, removed):
+        if not changed and not removed:
+            return
+        try:
+            with self._connect() as db:
+                db.executemany("DELETE FROM movies WHERE name = ?", [(name,) for name in removed])
+                db.executemany(
+                    "INSERT OR REPLACE INTO movies (name, dir_mtime, meta_mtime, info) VALUES (?, ?, ?, ?)",
+                    [(name, *mtimes, json.dumps(info)) for name, mtimes, info in changed]
+                )
+        except sqlite3.Error as e:
+            self.logger.warning(f"Failed to save library snapshot: {e}")
+
+    # reads a folder's metadata, returning (mtimes, info), info is None if the folder isn't a playable movie
+    def _read_folder(self, name):
+        movie_dir = os.path.join(self.media_path, name)
+        metadata_path = os.path.join(movie_dir, "metadata.json")
+        mtimes = (_mtime(movie_dir), _mtime(metadata_path))
+        if mtimes[1] is None:
+            return mtimes, None
+        try:
+            with open(metadata_path, encoding='utf-8') as f:
+                metadata = json.load(f)
+        except Exception as e:
+            self.logger.warning(f"Failed to read metadata for {name}: {e}")
+            return mtimes, None
+        return mtimes, movie_info(name, metadata)
+
+    # re-reads a single movie folder, called whenever the app changes one
+    def refresh(self, name):
+        mtimes, info = self._read_folder(name)
+        with self.lock:
+            if info is None:
+                removed = [name] if self.movies.pop(name, None) else []
+                self.mtimes.pop(name, None)
+                changed = []
+            else:
+                self.movies[name] = info
+                self.mtimes[name] = mtimes
+                changed, removed = [(name, mtimes, info)], []
+        self._save_snapshot(changed, removed)
+
+    # drops a deleted movie folder from the index
+    def remove(self, name):
+        with self.lock:
+            self.movies.pop(name, None)
+            self.mtimes.pop(name, None)
+        self._save_snapshot([], [name])
+
+    # cheap check for changes made outside the app, only one stat unless the library folder changed or a sweep is due
+    def revalidate(self, force=False):
+        root_mtime = _mtime(self.media_path)
+        now = time.monotonic()
+        if not force and root_mtime == self.root_mtime and now - self.last_sweep < LIBRARY_RESCAN_INTERVAL:
+            return
+        self.root_mtime = root_mtime
+        self.last_sweep = now
+
+        try:
+            names = {entry.name for entry in os.scandir(self.media_path) if entry.is_dir()}
+        except OSError as e:
+            self.logger.warning(f"Failed to scan media library: {e}")
+            return
+
+        changed, unplayable = [], set()
+        for name in names:
+            movie_dir = os.path.join(self.media_path, name)
+            mtimes = (_mtime(movie_dir), _mtime(os.path.join(movie_dir, "metadata.json")))
+            if self.mtimes.get(name) == mtimes:
+                continue
+            mtimes, info = self._read_folder(name)
+            if info is None:
+                unplayable.add(name)
+            else:
+                changed.append((name, mtimes, info))
+
+        with self.lock:
+            removed = [name for name in self.movies if name not in names or name in unplayable]
+            for name in removed:
+                self.movies.pop(name, None)
+                self.mtimes.pop(name, None)
+            for name, mtimes, info in changed:
+                self.movies[name] = info
+                self.mtimes[name] = mtimes
+        self._save_snapshot(changed, removed)
+
+    # returns an indexed movie's info given its folder name, None if it isn't in the library
+    def get(self, name):
+        with self.lock:
+            return self.movies.get(name)
+
+    # returns every indexed movie, without touching the filesystem
+    def all(self):
+        with self.lock:
+            return list(self.movies.values())
+
+
+library = LibraryIndex()
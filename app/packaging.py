@@ -0,0 +1,104 @@
+from .jobs import job_queue
+from .probe import probe
+from flask import current_app
+from dotenv import load_dotenv
+import subprocess
+import shutil
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+HLS_SEGMENT_SECONDS = int(os.getenv("HLS_SEGMENT_SECONDS", 6))
+# extra transcoded rungs as height:video bitrate, e.g. "720:2500k,480:1200k", the source rung is always copied
+HLS_RUNGS = [rung.split(":") for rung in os.getenv("HLS_RUNGS", "").split(",") if rung]
+BROWSER_HEVC = os.getenv("BROWSER_HEVC", "0") == "1"  # only Safari (and Edge with hardware support) plays hevc
+BROWSER_VIDEO_CODECS = {"h264", "hevc"} if BROWSER_HEVC else {"h264"}
+BROWSER_AUDIO_CODECS = {"aac", "mp3"}
+HLS_MASTER = os.path.join("hls", "master.m3u8")  # relative to the movie folder
+PACKAGE_WORKERS = int(os.getenv("PACKAGE_WORKERS", 1))        # per process, packaging stays off the shared job pool
+PACKAGE_TIMEOUT = float(os.getenv("PACKAGE_TIMEOUT", 4 * 3600))  # seconds per ffmpeg run, transcoded rungs are slow
+
+
+# returns the finalized movie file in a movie folder, None if there isn't one
+def find_movie_file(base_path):
+    for name in sorted(os.listdir(base_path)):
+        if name.startswith("movie."):
+            return os.path.join(base_path, name)
+    return None
+
+
+# queues hls packaging of a finalized movie folder, unless it's been packaged already
+def enqueue_package(base_path):
+    if os.path.exists(os.path.join(base_path, HLS_MASTER)):
+        return False
+    return job_queue.enqueue("package", f"package:{os.path.basename(base_path)}", {"base_path": base_path})
+
+
+# ffmpeg arguments for one hls rung written into out_dir
+def _rung_args(out_dir, video_args, audio_args):
+    return [
+        "-map", "0:v:0", "-map", "0:a:0?", *video_args, *audio_args,
+        "-f", "hls", "-hls_time", str(HLS_SEGMENT_SECONDS), "-hls_playlist_type", "vod",
+        "-hls_segment_type", "fmp4", "-hls_fmp4_init_filename", "init.mp4",
+        "-hls_segment_filename", os.path.join(out_dir, "seg_%05d.m4s"),
+        os.path.join(out_dir, "index.m3u8")
+    ]
+
+
+# remuxes the movie into fMP4 hls segments (copying codecs where the browser can play them) plus any extra
+# transcoded rungs, writing the master playlist last so the player only switches once everything is there,
+# every ffmpeg run holds a transcode slot so packaging shares the cpu budget of on-demand transcoding
+def package(job):
+    from .transcoder import transcoder
+    base_path = job["base_path"]
+    movie_file = find_movie_file(base_path)
+    if movie_file is None:
+        raise RuntimeError(f"No movie file to package in {base_path}")
+
+    media = probe(movie_file)
+    video = media["video"]
+    audio = media["audio"][0] if media["audio"] else None
+    if video is None:
+        raise RuntimeError(f"No video stream in {movie_file}")
+
+    hls_dir = os.path.join(base_path, "hls")
+    shutil.rmtree(hls_dir, ignore_errors=True)
+
+    copy_audio = audio is None or audio["codec"] in BROWSER_AUDIO_CODECS
+    audio_args = ["-c:a", "copy"] if copy_audio else ["-c:a", "aac", "-b:a", "160k", "-ac", "2"]
+    if video["codec"] in BROWSER_VIDEO_CODECS:
+        video_args = ["-c:v", "copy"] + (["-tag:v", "hvc1"] if video["codec"] == "hevc" else [])
+    else:
+        video_args = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "21"]
+
+    duration = media["duration"]
+    source_bandwidth = int(os.path.getsize(movie_file) * 8 / duration) if duration else 8000000
+    rungs = [("source", video_args, audio_args, source_bandwidth, video.get("width"), video.get("height"))]
+    for height, bitrate in HLS_RUNGS:
+        if video.get("height") and int(height) >= video["height"]:
+            continue
+        bandwidth = int(bitrate.rstrip("k")) * 1000 + 128000
+        rungs.append((f"{height}p", ["-vf", f"scale=-2:{height}", "-c:v", "libx264", "-preset", "veryfast",
+                                     "-b:v", bitrate, "-maxrate", bitrate, "-bufsize", bitrate],
+                      ["-c:a", "aac", "-b:a", "128k", "-ac", "2"], bandwidth, None, int(height)))
+
+    for name, rung_video, rung_audio, _, _, _ in rungs:
+        out_dir = os.path.join(hls_dir, name)
+        os.makedirs(out_dir, exist_ok=True)
+        with transcoder.slot(ttl=PACKAGE_TIMEOUT):
+            subprocess.run(["ffmpeg", "-y", "-v", "error", "-i", movie_file, *_rung_args(out_dir, rung_video, rung_audio)],
+                           check=True, timeout=PACKAGE_TIMEOUT)
+
+    lines = ["#EXTM3U", "#EXT-X-VERSION:7"]
+    for name, _, _, bandwidth, width, height in rungs:
+        stream_inf = f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth}"
+        if width and height:
+            stream_inf += f",RESOLUTION={width}x{height}"
+        lines += [stream_inf, f"{name}/index.m3u8"]
+    tmp_path = os.path.join(base_path, HLS_MASTER + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, os.path.join(base_path, HLS_MASTER))
+    current_app.logger.info(f"Packaged {movie_file} into {len(rungs)} hls rung(s)")
+
+
+job_queue.register("package", package, workers=PACKAGE_WORKERS)
@@ -0,0 +1,123 @@
+from .utils import fetch_tmdb_movie, write_metadata, download_poster
+from .finalize import finalize_movie_folder
+from concurrent.futures import ThreadPoolExecutor, wait
+from .packaging import enqueue_package, find_movie_file
+from .probe import probe
+from .faststart import faststart, FASTSTART
+from .subtitles import fetch_subtitles, movie_hash
+from .thumbnails import generate_thumbnails
+from .jobs import job_queue
+from flask import current_app
+import subprocess
+import time
+import os
+
+POSTPROCESS_DEADLINE = float(os.getenv("POSTPROCESS_DEADLINE", 120))  # seconds for all fetches together
+REQUEST_TIMEOUT = 30  # seconds, per outbound request
+
+
+# job key for a movie's post-processing, one per tmdb id
+def post_process_key(tmdb_id):
+    return f"post_process:{tmdb_id}"
+
+
+# queues post-processing of a completed download, returns immediately
+def enqueue_post_process(tmdb_id, movie_title, base_path):
+    return job_queue.enqueue("post_process", post_process_key(tmdb_id), {
+        "tmdb_id": tmdb_id,
+        "movie_title": movie_title,
+        "base_path": base_path
+    })
+
+
+# runs fn inside an app context, recording how long it took under given stage name
+def _timed(app, timings, stage, fn, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        with app.app_context():
+            return fn(*args, **kwargs)
+    finally:
+        timings[stage] = round(time.perf_counter() - start, 2)
+
+
+# fetches tmdb details and the poster and makes its thumbnails, then writes metadata.json (with the movie file's
+# probe and faststart result) last so the movie only appears once its poster is there
+def _metadata_and_poster(app, timings, tmdb_id, base_path, layout=None):
+    data = _timed(app, timings, "metadata", fetch_tmdb_movie, tmdb_id)
+    if data is None:
+        return False
+
+    poster_path = data.get("poster_path")
+    thumbnails = None
+    if poster_path:
+        if _timed(app, timings, "poster", download_poster, poster_path, base_path, timeout=REQUEST_TIMEOUT):
+            thumbnails = _timed(app, timings, "thumbnails", generate_thumbnails, base_path)
+    else:
+        app.logger.warning(f"No poster path for TMDb ID {tmdb_id}")
+
+    with app.app_context():
+        media = _timed(app, timings, "probe", _probe_movie, base_path)
+        if media and layout:
+            media = dict(media, faststart=layout)
+        return write_metadata(tmdb_id, data, base_path, thumbnails, media)
+
+
+# probe summary of a movie folder's movie file, None if it can't be probed (the player then probes it itself)
+def _probe_movie(base_path):
+    movie_file = find_movie_file(base_path)
+    try:
+        return probe(movie_file) if movie_file else None
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        current_app.logger.warning(f"Failed to probe {movie_file}: {e}")
+        return None
+
+
+# finalizes the folder and moves an mp4's moov to the front, then fetches metadata/poster and subtitles concurrently within one overall deadline,
+# only metadata is required to succeed, safe to re-run after a partial failure
+def post_process(job):
+    tmdb_id, movie_title, base_path = job["tmdb_id"], job["movie_title"], job["base_path"]
+    app = current_app._get_current_object()
+    timings = {}
+
+    already_finalized = any(name.startswith("movie.") for name in os.listdir(base_path))
+    finalized = None
+    if not already_finalized:
+        runtime = (fetch_tmdb_movie(tmdb_id) or {}).get("runtime")  # cached, picks the main feature
+        finalized = _timed(app, timings, "finalize", finalize_movie_folder, base_path, runtime=runtime)
+        if not finalized:
+            raise RuntimeError(f"Failed to finalize {base_path}")
+
+    # the opensubtitles hash covers the file's first and last 64KB, which moving the moov changes,
+    # so it's taken from the file as downloaded
+    movie_file = find_movie_file(base_path)
+    file_hash = movie_hash(movie_file) if movie_file else None
+
+    # before anything else reads the file, a no-op once it's been done
+    layout = None
+    if FASTSTART and movie_file:
+        try:
+            layout = _timed(app, timings, "faststart", faststart, movie_file)
+        except (OSError, subprocess.CalledProcessError) as e:
+            current_app.logger.warning(f"Faststart rewrite of {movie_file} failed, it still plays: {e}")
+    enqueue_package(base_path)
+
+    pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="post-process")
+    metadata = pool.submit(_metadata_and_poster, app, timings, tmdb_id, base_path, layout)
+    subtitles = pool.submit(_timed, app, timings, "subtitles", fetch_subtitles, tmdb_id, movie_title, base_path,
+                            file_hash, app.config['SUBTITLE_CACHE_PATH'], timeout=REQUEST_TIMEOUT)
+    done, not_done = wait([metadata, subtitles], timeout=POSTPROCESS_DEADLINE)
+    pool.shutdown(wait=False)  # anything still running past the deadline finishes in the background
+
+    io = f", finalize i/o {finalized['io_read']}B read {finalized['io_write']}B written ({finalized['method']})" if finalized else ""
+    current_app.logger.info(f"Post-processed {movie_title} in stages {timings}, {len(not_done)} past deadline{io}")
+
+    # movie is still watchable without subtitles, or a poster
+    if subtitles in done and subtitles.exception():
+        current_app.logger.warning(f"Subtitle fetch failed for {movie_title}: {subtitles.exception()}")
+    if metadata not in done:
+        raise RuntimeError(f"Metadata fetch for TMDb ID {tmdb_id} missed the {POSTPROCESS_DEADLINE}s deadline")
+    if not metadata.result():
+        raise RuntimeError(f"Failed to fetch metadata for TMDb ID {tmdb_id}")
+
+
+job_queue.register("post_process", post_process)
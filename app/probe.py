@@ -0,0 +1,97 @@
+from .state import state
+from flask import current_app
+import subprocess
+import json
+import os
+
+MAIN_FEATURE_MIN_SHARE = 0.5   # a candidate shorter than this share of tmdb's runtime is an extra, not the movie
+MIN_CANDIDATE_SHARE = 0.01     # files smaller than this share of the biggest aren't worth probing (samples, nfo videos)
+
+
+# ffprobe's view of a file's streams and format
+def probe_streams(path):
+    out = subprocess.run(
+        ["ffprobe", "-v", "error", "-print_format", "json", "-show_streams", "-show_format", path],
+        check=True, capture_output=True
+    ).stdout
+    return json.loads(out)
+
+
+# the parts of ffprobe's output the app uses: container, duration, the first video stream and every audio stream
+def summarize(info):
+    fmt = info.get("format", {})
+    streams = info.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video"
+                  and not s.get("disposition", {}).get("attached_pic")), None)  # not cover art
+    audio = [s for s in streams if s.get("codec_type") == "audio"]
+    return {
+        "container": fmt.get("format_name"),
+        "duration": float(fmt.get("duration") or 0),
+        "bit_rate": int(fmt.get("bit_rate") or 0),
+        "video": {
+            "codec": video.get("codec_name"),
+            "width": video.get("width"),
+            "height": video.get("height")
+        } if video else None,
+        "audio": [{
+            "codec": s.get("codec_name"),
+            "channels": s.get("channels"),
+            "language": s.get("tags", {}).get("language")
+        } for s in audio],
+        "audio_languages": sorted({s.get("tags", {}).get("language") for s in audio} - {None, "und"})
+    }
+
+
+# cached summary of a media file given its os.stat, None if it hasn't been probed since it last changed
+def cached(st):
+    entry = state.get("probe", f"{st.st_dev}:{st.st_ino}")
+    if entry and entry["size"] == st.st_size and entry["mtime"] == st.st_mtime:
+        return entry["summary"]
+    return None
+
+
+# summary of a media file, ffprobe only runs once per version of the file: the result is kept in the shared
+# state store keyed by inode, so it survives the finalize hardlink/rename, and checked against size and mtime
+def probe(path):
+    st = os.stat(path)
+    key = f"{st.st_dev}:{st.st_ino}"
+    summary = cached(st)
+    if summary is not None:
+        return summary
+    summary = summarize(probe_streams(path))
+    state.set("probe", key, {"path": path, "size": st.st_size, "mtime": st.st_mtime, "summary": summary})
+    return summary
+
+
+# forgets cached probes of files under given folder, e.g. once it's deleted
+def forget(base_path):
+    prefix = os.path.join(base_path, "")
+    for key, cached in state.items("probe").items():
+        if cached["path"].startswith(prefix):
+            state.delete("probe", key)
+
+
+# picks the main feature among video files, the one whose duration is closest to tmdb's runtime (minutes),
+# the longest one without a runtime, falls back to the biggest file if none of them could be probed
+def pick_main_feature(paths, runtime=None):
+    sizes = {path: os.path.getsize(path) for path in paths}
+    if not sizes:
+        return None
+    biggest = max(sizes.values())
+    durations = {}
+    for path, size in sizes.items():
+        if size < biggest * MIN_CANDIDATE_SHARE:
+            continue
+        try:
+            durations[path] = probe(path)["duration"]
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            current_app.logger.warning(f"Failed to probe {path}: {e}")
+    durations = {path: duration for path, duration in durations.items() if duration > 0}
+    if not durations:
+        return max(sizes, key=sizes.get)
+
+    if runtime:
+        target = runtime * 60
+        features = {path: d for path, d in durations.items() if d >= target * MAIN_FEATURE_MIN_SHARE} or durations
+        return min(features, key=lambda path: (abs(features[path] - target), -sizes[path]))
+    return max(durations, key=lambda path: (durations[path], sizes[path]))
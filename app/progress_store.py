@@ -0,0 +1,143 @@
+from .utils import load_progress
+from .state import state
+import threading
+import atexit
+import json
+import time
+import os
+
+PROGRESS_FLUSH_INTERVAL = float(os.getenv("PROGRESS_FLUSH_INTERVAL", 2))  # seconds between flushes to the state store
+
+
+# newer of a stored [seconds, time of update] and a flushed one, so a worker flushing an older update
+# late can't overwrite a newer one flushed by another worker
+def _newest(stored, new):
+    if isinstance(stored, list) and stored[1] >= new[1]:
+        return None
+    return new
+
+
+# seconds from a stored value, plain numbers are from before updates were timestamped
+def _seconds(value):
+    return value[0] if isinstance(value, list) else value
+
+
+# write-behind store for playback progress on top of the shared state store, so every worker sees the same
+# progress: updates are buffered in memory and written in batches, one transaction per flush, and reads
+# overlay this worker's not yet flushed updates on what's stored
+class ProgressStore:
+    def __init__(self):
+        self.lock = threading.Lock()         # guards the pending buffer
+        self.flush_lock = threading.Lock()
+        self.pending = {}   # user -> {movie -> [seconds, time of update]}, not yet flushed
+        self.stop = threading.Event()
+        self.counters = {
+            "flushes": 0,
+            "entries_flushed": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_flush_ms": 0.0,
+            "total_flush_ms": 0.0
+        }
+
+    def init_app(self, app):
+        self.path = app.config['PROGRESS_PATH']
+        self.journal_path = app.config['PROGRESS_JOURNAL_PATH']
+        self.logger = app.logger
+        self._migrate()
+        threading.Thread(target=self._flush_loop, name="progress-flush", daemon=True).start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _ns(user):
+        return f"progress:{user}"
+
+    # imports user_progress.json and its journal from before the state store, once, by whichever worker gets there first
+    def _migrate(self):
+        with state.lock("progress-migration"):
+            if state.get("meta", "progress_migrated") or not os.path.exists(self.path):
+                return
+            data = load_progress(self.path)
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            user, movie, seconds = json.loads(line)
+                        except ValueError:
+                            continue  # torn final line from a crash mid-append
+                        data.setdefault(user, {})[movie] = seconds
+            for user, movies in data.items():
+                state.set_many(self._ns(user), movies)
+            state.set("meta", "progress_migrated", True)
+            self.logger.info(f"Migrated progress of {len(data)} user(s) from {self.path}")
+
+    # seconds watched of given movie by given user
+    def get(self, user, movie):
+        with self.lock:
+            value = self.pending.get(user, {}).get(movie)
+        if value is None:
+            value = state.get(self._ns(user), movie)
+        return _seconds(value) or 0
+
+    def set(self, user, movie, seconds):
+        with self.lock:
+            self.pending.setdefault(user, {})[movie] = [seconds, time.time()]
+
+    # copy of one user's progress, movie -> seconds
+    def all_for_user(self, user):
+        movies = state.items(self._ns(user))
+        with self.lock:
+            movies.update(self.pending.get(user, {}))
+        return {movie: _seconds(value) for movie, value in movies.items()}
+
+    # writes buffered updates to the state store, one batch per user
+    def flush(self):
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+            if not batch:
+                return
+
+            start = time.perf_counter()
+            try:
+                for user, movies in batch.items():
+                    state.merge_many(self._ns(user), movies, _newest)
+            except Exception:
+                with self.lock:  # put them back for the next flush, unless newer updates came in meanwhile
+                    for user, movies in batch.items():
+                        self.pending[user] = {**movies, **self.pending.get(user, {})}
+                raise
+            elapsed = (time.perf_counter() - start) * 1000
+
+            size = sum(len(movies) for movies in batch.values())
+            c = self.counters
+            c["flushes"] += 1
+            c["entries_flushed"] += size
+            c["last_batch_size"] = size
+            c["max_batch_size"] = max(c["max_batch_size"], size)
+            c["last_flush_ms"] = round(elapsed, 3)
+            c["total_flush_ms"] += elapsed
+
+    def _flush_loop(self):
+        while not self.stop.wait(PROGRESS_FLUSH_INTERVAL):
+            try:
+                self.flush()
+            except Exception as e:
+                self.logger.error(f"Failed to flush progress: {e}")
+
+    def close(self):
+        self.stop.set()
+        self.flush()
+
+    # counters for tuning the flush interval
+    def stats(self):
+        c = dict(self.counters)
+        total_flush_ms = c.pop("total_flush_ms")
+        c["avg_flush_ms"] = round(total_flush_ms / c["flushes"], 3) if c["flushes"] else 0.0
+        with self.lock:
+            c["pending"] = sum(len(movies) for movies in self.pending.values())
+        c["flush_interval"] = PROGRESS_FLUSH_INTERVAL
+        return c
+
+
+progress_store = ProgressStore()
@@ -0,0 +1,88 @@
+from requests.adapters import HTTPAdapter
+from dotenv import load_dotenv
+import threading
+import requests
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+QBITTORRENT_TIMEOUT = float(os.getenv("QBITTORRENT_TIMEOUT", 10))     # seconds, per request
+QBITTORRENT_POOL_SIZE = int(os.getenv("QBITTORRENT_POOL_SIZE", 4))    # keep-alive connections
+
+
+class QBittorrentError(Exception):
+    pass
+
+
+# long-lived qBittorrent Web API client: logs in once, reuses the SID cookie over a keep-alive
+# connection pool, and logs in again (once) when qBittorrent answers 403 because the SID expired
+class QBittorrentClient:
+    def __init__(self, host, username, password, timeout=QBITTORRENT_TIMEOUT, pool_size=QBITTORRENT_POOL_SIZE):
+        self.host = (host or "").rstrip("/")
+        self.username = username
+        self.password = password
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.login_lock = threading.Lock()
+        self.sid_generation = 0   # bumped on every successful login
+
+    def login(self):
+        r = self.session.post(f"{self.host}/api/v2/auth/login",
+                              data={"username": self.username, "password": self.password},
+                              timeout=self.timeout)
+        if r.status_code != 200 or r.text != "Ok.":
+            raise QBittorrentError(f"qBittorrent login failed: {r.status_code} {r.text}")
+        self.sid_generation += 1
+
+    # logs in unless another thread already did since generation was observed
+    def _ensure_login(self, generation):
+        with self.login_lock:
+            if self.sid_generation == generation:
+                self.login()
+
+    def _request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        generation = self.sid_generation
+        if generation == 0:
+            self._ensure_login(generation)
+            generation = self.sid_generation
+
+        r = self.session.request(method, f"{self.host}{path}", **kwargs)
+        if r.status_code == 403:  # SID expired or qBittorrent restarted
+            self._ensure_login(generation)
+            r = self.session.request(method, f"{self.host}{path}", **kwargs)
+        if r.status_code != 200:
+            raise QBittorrentError(f"qBittorrent {path} failed: {r.status_code} {r.text}")
+        return r
+
+    # adds torrent from magnet/url, saving into given path
+    def add_torrent(self, urls, save_path, category="media"):
+        self._request("POST", "/api/v2/torrents/add", data={
+            "urls": urls,
+            "savepath": save_path,
+            "category": category
+        })
+        return True
+
+    def torrents_info(self, category=None):
+        params = {"category": category} if category else None
+        return self._request("GET", "/api/v2/torrents/info", params=params).json()
+
+    # incremental state since response id rid, 0 for a full update
+    def sync_maindata(self, rid=0):
+        return self._request("GET", "/api/v2/sync/maindata", params={"rid": rid}).json()
+
+    def delete_torrents(self, hashes, delete_files=True):
+        self._request("POST", "/api/v2/torrents/delete", data={
+            "hashes": "|".join(hashes) if isinstance(hashes, (list, tuple, set)) else hashes,
+            "deleteFiles": "true" if delete_files else "false"
+        })
+
+
+qbittorrent = QBittorrentClient(
+    os.getenv("QBITTORRENT_HOST"),
+    os.getenv("QBITTORRENT_USER"),
+    os.getenv("QBITTORRENT_PASS")
+)
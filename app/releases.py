@@ -0,0 +1,206 @@
+from dotenv import load_dotenv
+import unicodedata
+import math
+import re
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+RELEASE_PREFERRED_RESOLUTION = int(os.getenv("RELEASE_PREFERRED_RESOLUTION", 1080))
+RELEASE_MAX_SIZE = float(os.getenv("RELEASE_MAX_SIZE_GB", 20)) * 1024 ** 3
+RELEASE_SEEDER_RATE = float(os.getenv("RELEASE_SEEDER_RATE_KB", 250)) * 1024  # bytes/s we expect from each seeder
+RELEASE_CONFIDENT_SCORE = float(os.getenv("RELEASE_CONFIDENT_SCORE", 0.8))  # stop searching once a release scores this
+# scorer weights over the defaults, e.g. "resolution=4,eta=0"
+RELEASE_WEIGHTS = {name.strip(): float(weight) for name, _, weight in
+                   (item.partition("=") for item in os.getenv("RELEASE_WEIGHTS", "").split(",") if "=" in item)}
+DEFAULT_RUNTIME = 120  # minutes, when tmdb doesn't know
+
+RESOLUTIONS = [480, 576, 720, 1080, 2160]
+IDEAL_MB_PER_MINUTE = {480: 8, 576: 10, 720: 20, 1080: 40, 2160: 120}  # typical good encode at each resolution
+MIN_MB_PER_MINUTE = 1.5  # anything smaller for the runtime is a sample, a trailer or a different cut
+CODEC_SCORES = {"x264": 1.0, "x265": 0.8, "av1": 0.6, "xvid": 0.2, None: 0.5}  # h264 plays in every browser
+SOURCE_SCORES = {"bluray": 1.0, "web-dl": 0.9, "webrip": 0.8, "remux": 0.6, "hdtv": 0.5, "dvd": 0.4, None: 0.5}
+
+RESOLUTION = re.compile(r"(?<![a-z0-9])(2160|1080|720|576|480)[pi](?![a-z0-9])|(?<![a-z0-9])(4k|uhd)(?![a-z0-9])")
+YEAR = re.compile(r"(?<!\d)(19\d\d|20\d\d)(?![\dpi])")
+CODECS = [
+    ("x265", re.compile(r"(?<![a-z0-9])(x265|h\.?265|hevc)(?![a-z0-9])")),
+    ("x264", re.compile(r"(?<![a-z0-9])(x264|h\.?264|avc)(?![a-z0-9])")),
+    ("av1", re.compile(r"(?<![a-z0-9])av1(?![a-z0-9])")),
+    ("xvid", re.compile(r"(?<![a-z0-9])(xvid|divx)(?![a-z0-9])"))
+]
+SOURCES = [  # checked in order, the first match wins
+    ("cam", re.compile(r"(?<![a-z0-9])(cam|camrip|hdcam|ts|hdts|telesync|tc|telecine|scr|screener|dvdscr)(?![a-z0-9])")),
+    ("remux", re.compile(r"(?<![a-z0-9])remux(?![a-z0-9])")),
+    ("bluray", re.compile(r"(?<![a-z0-9])(blu-?ray|bdrip|brrip|bd)(?![a-z0-9])")),
+    ("web-dl", re.compile(r"(?<![a-z0-9])web-?dl(?![a-z0-9])")),
+    ("webrip", re.compile(r"(?<![a-z0-9])(web-?rip|web)(?![a-z0-9])")),
+    ("hdtv", re.compile(r"(?<![a-z0-9])(hdtv|pdtv)(?![a-z0-9])")),
+    ("dvd", re.compile(r"(?<![a-z0-9])(dvdrip|dvd|dvd5|dvd9)(?![a-z0-9])"))
+]
+
+
+# a release that must never be picked, whatever its score, scorer is the name of the scorer that rejected it
+class Rejected(Exception):
+    scorer = None
+
+
+# lowercases and strips accents and punctuation, so "Amélie (2001)" and "Amelie.2001" compare equal
+def _fold(text):
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]+", "", text.lower())
+
+
+# parses a release title into its structured fields
+def parse_release(title):
+    lowered = title.lower()
+    resolution = RESOLUTION.search(lowered)
+    return {
+        "resolution": (int(resolution.group(1)) if resolution.group(1) else 2160) if resolution else None,
+        "codec": next((name for name, pattern in CODECS if pattern.search(lowered)), None),
+        "source": next((name for name, pattern in SOURCES if pattern.search(lowered)), None),
+        "years": [int(year) for year in YEAR.findall(title)]
+    }
+
+
+# scorers each rate one aspect of a release from 0 to 1, or raise Rejected,
+# given (jackett result, parsed fields, tmdb movie details)
+
+def score_resolution(result, fields, movie):
+    if fields["resolution"] is None:
+        return 0.4
+    distance = abs(RESOLUTIONS.index(fields["resolution"]) - RESOLUTIONS.index(_preferred_resolution()))
+    return max(0.0, 1 - 0.3 * distance)
+
+
+def score_codec(result, fields, movie):
+    return CODEC_SCORES[fields["codec"]]
+
+
+def score_source(result, fields, movie):
+    if fields["source"] == "cam":
+        raise Rejected("cam/telesync source")
+    return SOURCE_SCORES[fields["source"]]
+
+
+# years in the release title must include tmdb's release year (give or take one), if it has any
+def score_year(result, fields, movie):
+    year = (movie.get("release_date") or "")[:4]
+    if not year or not fields["years"]:
+        return 0.5
+    if any(abs(int(year) - found) <= 1 for found in fields["years"]):
+        return 1.0
+    raise Rejected(f"year {fields['years']} doesn't match {year}")
+
+
+# size has to make sense for tmdb's runtime, the closer to a typical encode at that resolution the better
+def score_size(result, fields, movie):
+    size = result.get("Size") or 0
+    if not size:
+        return 0.3
+    if size > RELEASE_MAX_SIZE:
+        raise Rejected(f"{size / 1024 ** 3:.1f}GB is over the size limit")
+    mb_per_minute = size / 1024 ** 2 / (movie.get("runtime") or DEFAULT_RUNTIME)
+    if mb_per_minute < MIN_MB_PER_MINUTE:
+        raise Rejected(f"{size / 1024 ** 2:.0f}MB is too small for a {movie.get('runtime')} minute runtime")
+    ideal = IDEAL_MB_PER_MINUTE.get(fields["resolution"] or _preferred_resolution())
+    return math.exp(-abs(math.log(mb_per_minute / ideal)))
+
+
+def score_seeders(result, fields, movie):
+    seeders = result.get("Seeders") or 0
+    if seeders <= 0:
+        raise Rejected("no seeders")
+    peers = result.get("Peers") or 0
+    return min(1.0, math.log10(seeders + 1) / 3 + min(peers, 100) / 1000)  # ~1000 seeders scores 1
+
+
+# expected download time from size and swarm, an hour or more scores close to zero
+def score_eta(result, fields, movie):
+    size = result.get("Size") or 0
+    seeders = result.get("Seeders") or 0
+    if not size or not seeders:
+        return 0.0
+    eta = size / (RELEASE_SEEDER_RATE * min(seeders, 20))
+    return 1 / (1 + eta / 900)
+
+
+# the release has to contain the movie's title (or original title), a closer match scores higher
+def score_title(result, fields, movie):
+    release = _fold(result.get("Title", ""))
+    titles = [_fold(title) for title in (movie.get("title"), movie.get("original_title")) if title]
+    matches = [title for title in titles if title and title in release]
+    if not matches:
+        raise Rejected("title doesn't match")
+    return 1.0 if any(release.startswith(title) for title in matches) else 0.7
+
+
+def _preferred_resolution():
+    return RELEASE_PREFERRED_RESOLUTION if RELEASE_PREFERRED_RESOLUTION in RESOLUTIONS else 1080
+
+
+# name -> (scorer, default weight), more can be added with register_scorer
+SCORERS = {
+    "title": (score_title, 3),
+    "resolution": (score_resolution, 3),
+    "source": (score_source, 2),
+    "codec": (score_codec, 1),
+    "year": (score_year, 1),
+    "size": (score_size, 1),
+    "seeders": (score_seeders, 2),
+    "eta": (score_eta, 2)
+}
+
+
+def register_scorer(name, scorer, weight=1):
+    SCORERS[name] = (scorer, weight)
+
+
+# every scorer's weight, RELEASE_WEIGHTS over the defaults
+def weights():
+    return {name: RELEASE_WEIGHTS.get(name, weight) for name, (_, weight) in SCORERS.items()}
+
+
+# scores one release, returns (score, {scorer: score}), raises Rejected if it shouldn't be downloaded
+def score_release(result, movie, weighting=None):
+    weighting = weighting or weights()
+    fields = parse_release(result.get("Title", ""))
+    scores = {}
+    for name, (scorer, _) in SCORERS.items():
+        try:
+            scores[name] = scorer(result, fields, movie)
+        except Rejected as e:
+            e.scorer = name
+            raise
+    total = sum(weighting.values()) or 1
+    return sum(scores[name] * weighting[name] for name in scores) / total, scores
+
+
+# ranks jackett results for a movie, best first, as (score, result, {scorer: score}), dropping rejected ones,
+# also returns {scorer: count} of which scorers rejected releases
+def rank_releases(results, movie):
+    weighting = weights()
+    ranked, rejected = [], {}
+    for result in results:
+        if not result.get("MagnetUri") and not result.get("Link"):
+            continue
+        try:
+            score, scores = score_release(result, movie, weighting)
+        except Rejected as e:
+            rejected[e.scorer] = rejected.get(e.scorer, 0) + 1
+            continue
+        ranked.append((score, result, scores))
+    ranked.sort(key=lambda r: r[0], reverse=True)
+    return ranked, rejected
+
+
+# whether any of the results so far is good enough to stop waiting for slower indexers
+def confident(results, movie):
+    ranked, _ = rank_releases(results, movie)
+    return bool(ranked) and ranked[0][0] >= RELEASE_CONFIDENT_SCORE
+
+
+# jackett queries to try in order, with the year first, then the bare title for indexers that don't match on it
+def release_queries(movie):
+    title = movie["title"]
+    year = (movie.get("release_date") or "")[:4]
+    return [f"{title} {year}", title] if year else [title]
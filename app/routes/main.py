@@ -1,85 +1,53 @@
-from ..utils import load_progress, search_and_download_subtitle, finalize_movie_folder, download_poster_and_metadata, normalize
-from flask import Blueprint, request, render_template, current_app, session, jsonify, redirect, url_for
-from urllib.parse import urlencode
-from dotenv import load_dotenv
+from ..utils import normalize
+from ..library import library
+from ..disk_usage import disk_usage
+from ..progress_store import progress_store
+from ..qbittorrent import qbittorrent, QBittorrentError
+from ..torrent_poller import torrent_poller
+from ..postprocess import post_process_key
+from ..downloads import downloads
+from ..packaging import find_movie_file, HLS_MASTER
+from ..transcoder import transcoder, needs_transcode, BROWSER_CONTAINERS
+from .. import probe
+from ..subtitles import subtitle_tracks
+from ..thumbnails import THUMBNAIL_SIZES
+from ..streaming import prefetch
+from ..jobs import job_queue
+from ..tmdb import tmdb, TMDbError
+from ..jackett import jackett
+from flask import Blueprint, request, render_template, current_app, session, jsonify, redirect, url_for, Response, stream_with_context
 import subprocess
 import requests
 import shutil
-import gzip
-import html
 import json
+import time
 import os
-import re
-
-load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
-JACKETT_API_KEY = os.getenv("JACKETT_API_KEY")
-TMDB_API_KEY = os.getenv("TMDB_API_KEY")
 
 bp = Blueprint("main", __name__)
-progress = {}
 MAX_SEARCH_RESULTS = 5
-in_progress_downloads = {}
-post_processed = set()
-completed_downloads = set()
-
-
-# initially loads the user's progress from the json data
-@bp.before_app_first_request
-def load_user_progress():
-    global progress
-    progress = load_progress(current_app.config['PROGRESS_PATH'])
-
+EVENTS_KEEPALIVE = 15        # seconds between SSE keepalive comments
+EVENTS_MAX_DURATION = 300    # seconds before an SSE stream is closed, EventSource reconnects on its own
 
 
 # home page, as well as POST request to search for tmdb movies
 @bp.route("/", methods=["GET", "POST"])
 def landing_page():
-    global progress
-    progress = load_progress(current_app.config['PROGRESS_PATH'])
-
-    media_path = current_app.config['MEDIA_PATH']
-    movies = []
-
-    # lists all available movies, ensuring they have correctly post-processed
-    for name in os.listdir(media_path):
-        movie_dir = os.path.join(media_path, name)
-        if os.path.isdir(movie_dir):
-            metadata_path = os.path.join(movie_dir, "metadata.json")
-            if not os.path.exists(metadata_path):
-                continue
-            try:
-                with open(metadata_path, encoding='utf-8') as f:
-                    metadata = json.load(f)
-            except Exception as e:
-                current_app.logger.warning(f"Failed to read metadata for {name}: {e}")
-                continue
-
-            # provides the movie's corresponding metadata/poster
-            poster = f"/media/{name}/poster.jpg"
-            encoded_name = html.escape(name, quote=True).replace("&#x27;", "&#39;")
-            seconds = progress.get(request.user_email, {}).get(encoded_name, 0)
-
-            movie_info = {
-                "name": name,
-                "poster": poster,
-                "progress_seconds": seconds,
-                "title": metadata.get("title", name),
-                "year": metadata.get("release_date", "")[:4],
-                "overview": metadata.get("overview", "No description available."),
-                "genres": metadata.get("genres", []),
-                "runtime": metadata.get("runtime"),
-                "rating": metadata.get("rating"),
-                "tmdb_id": metadata.get("tmdb_id")
-            }
-            movies.append(movie_info)
+    # lists all available movies from the library index, which only holds correctly post-processed folders
+    library.revalidate()
+    user_progress = progress_store.all_for_user(request.user_email)
+    movies = [
+        dict(info, progress_seconds=user_progress.get(info["encoded_name"], 0))
+        for info in library.all()
+    ]
 
     # initialise searched_movies if not present
     if "searched_movies" not in session:
         session["searched_movies"] = []
 
+    # drops requests that have made it into the library
     session["searched_movies"] = [
         m for m in session["searched_movies"]
-        if m["id"] not in completed_downloads
+        if (downloads.get(m["id"]) or {}).get("state") != "ready"
     ]
     session.modified = True
 
@@ -87,12 +55,11 @@ def landing_page():
     if request.method == "POST":
         query = request.form.get("query")
         if query:
-            url = "https://api.themoviedb.org/3/search/movie"
-            headers = {"Authorization": f"Bearer {TMDB_API_KEY}"}
-            params = {"query": query, "include_adult": False, "language": "en-US", "page": 1}
-            response = requests.get(url, headers=headers, params=params)
-            data = response.json()
-            results = data.get("results", [])
+            try:
+                results = tmdb.search_movie(query)
+            except (TMDbError, requests.RequestException) as e:
+                current_app.logger.error(f"TMDb search failed: {e}")
+                results = []
             if results:
 
                 query_normalized = normalize(query)
@@ -112,10 +79,8 @@ def landing_page():
                     session["searched_movies"].append(most_popular)
                     session.modified = True
 
-                    try:
-                        start_download(most_popular["id"])
-                    except Exception as e:
-                        current_app.logger.error(f"Auto-download failed: {e}")
+                    # the search and torrent add run in the background, progress arrives over /events
+                    downloads.request(most_popular["id"], most_popular["title"])
         return redirect(url_for("main.landing_page"))
 
     # passes session/user info to and returns the homepage html
@@ -123,7 +88,8 @@ def landing_page():
         "index.html",
         user_name=request.user_name,
         movies=movies,
-        searched_movies=session["searched_movies"]
+        searched_movies=session["searched_movies"],
+        thumbnail_sizes=THUMBNAIL_SIZES
     )
 
 
@@ -139,170 +105,165 @@ def remove_movie(movie_id):
 
 
 
-# returns movie and subtitles files given movie name
+# returns movie, hls playlist and every subtitle track given movie name, the playlist is the packaged one once it exists,
+# else on-demand transcoded segments if the browser can't play the file as is
 @bp.route("/movie/<movie_name>")
 def movie_page(movie_name):
-    movie_file = f"/media/{movie_name}/movie.mp4"
-    subtitles_file = f"/media/{movie_name}/subtitles.vtt"
-    return render_template("movie.html", movie_name=movie_name, movie_file=movie_file, subtitles_file=subtitles_file)
-
+    base_path = os.path.join(current_app.config['MEDIA_PATH'], movie_name)
+    movie_path = find_movie_file(base_path) if os.path.isdir(base_path) else None
+    movie_file = f"/media/{movie_name}/{os.path.basename(movie_path) if movie_path else 'movie.mp4'}"
+    info = library.get(movie_name) or {}
+    media = info.get("media")  # probed at ingest, so the page doesn't run ffprobe
+    hls_file = None
+    if os.path.exists(os.path.join(base_path, HLS_MASTER)):
+        hls_file = f"/media/{movie_name}/hls/master.m3u8"
+    elif movie_path:
+        try:
+            if needs_transcode(movie_path, media):
+                hls_file = url_for("transcode.playlist", movie_name=movie_name)
+        except (OSError, subprocess.CalledProcessError, ValueError) as e:
+            current_app.logger.warning(f"Failed to probe {movie_path}: {e}")
+    if movie_path and not hls_file:
+        # the player asks for it next, progress is keyed by the escaped name the homepage posts
+        prefetch(movie_path, progress_store.get(request.user_email, info.get("encoded_name", movie_name)))
+    tracks = [(lang, label, f"/media/{movie_name}/{name}") for lang, label, name in subtitle_tracks(base_path)]
+    movie_type = "video/mp4" if movie_file.lower().endswith(BROWSER_CONTAINERS) else None
+    return render_template("movie.html", movie_name=movie_name, movie_file=movie_file, movie_type=movie_type,
+                           hls_file=hls_file, subtitle_tracks=tracks)
+
+
+
+# given tmdb id of movie, queues its download, which then moves through searching, adding, downloading and
+# post-processing in the background
+@bp.route("/start_download/<int:tmdb_id>", methods=["POST"])
+def start_download(tmdb_id):
+    state = downloads.request(tmdb_id)
+    return jsonify({"status": state, "id": tmdb_id}), 202
 
 
-# helper function -> begins downloads on qbitorrent
-def start_qbittorrent_download(torrent_url, save_path):
-    qb_host = os.getenv("QBITTORRENT_HOST")
-    qb_user = os.getenv("QBITTORRENT_USER")
-    qb_pass = os.getenv("QBITTORRENT_PASS")
 
-    s = requests.Session()
-    # Login
-    login = s.post(f"{qb_host}/api/v2/auth/login", data={"username": qb_user, "password": qb_pass})
-    if login.status_code != 200 or login.text != "Ok.":
-        return False
+# returns torrenting progress of requested movie, from the poller's torrent table
+@bp.route("/download_status/<movie_title>")
+def download_status(movie_title):
+    torrent = torrent_poller.find(movie_title)
+    if torrent is None:
+        return jsonify({"error": "Torrent not found"}), 404
 
-    # Adds torrent
-    add = s.post(f"{qb_host}/api/v2/torrents/add", data={
-        "urls": torrent_url,
-        "savepath": save_path,
-        "category": "media"
+    return jsonify({
+        "progress": torrent["progress"],
+        "state": torrent["state"]
     })
-    return add.status_code == 200
-
 
 
-# given tmdb id of movie, begins the torrent download
-@bp.route("/start_download/<int:tmdb_id>", methods=["POST"])
-def start_download(tmdb_id):
-    # gets TMDb info
-    headers = {"Authorization": f"Bearer {TMDB_API_KEY}"}
-    response = requests.get(f"https://api.themoviedb.org/3/movie/{tmdb_id}", headers=headers)
-    movie_data = response.json()
-    movie_title = movie_data["title"]
-
-    in_progress_downloads[tmdb_id] = {
-        "title": movie_title,
-        "original_title": movie_data["title"]
-    }
-
-    # searches Jackett
-    jackett_url = f"http://localhost:9117/api/v2.0/indexers/all/results"
-    query = {
-        "apikey": JACKETT_API_KEY,
-        "Query": f"{movie_title} {movie_data.get('release_date', '')[:4]}" if movie_title.lower() != "casablanca" else movie_title
-    }
-
-    r = requests.get(jackett_url, params=query)
-    if r.status_code != 200:
-        return jsonify({"error": "Jackett search failed"}), 500
-
-    results = r.json().get("Results", [])
-    if not results:
-        return jsonify({"error": "No torrents found"}), 404
-
-    # chooses best torrent (by seeders)
-    filtered_results = [r for r in results if "1080p" in r["Title"].lower()]
-    if not filtered_results:
-        filtered_results = results  # fallback to all results
-    
-    # sorts by seeders
-    filtered_results.sort(key=lambda x: x.get("Seeders", 0), reverse=True)
-    best = filtered_results[0]
-
-    # starts download with qBittorrent
-    save_path = os.path.join(current_app.config['MEDIA_PATH'], movie_title)
-    os.makedirs(save_path, exist_ok=True)
-    success = start_qbittorrent_download(best["MagnetUri"], save_path)
-
-    if not success:
-        return jsonify({"error": "Failed to add torrent"}), 500
-
-    return jsonify({"status": "started", "title": movie_title})
-
-
-
-# returns torrenting progress of requested movie
-@bp.route("/download_status/<movie_title>")
-def download_status(movie_title):
-    qb_host = os.getenv("QBITTORRENT_HOST")
-    qb_user = os.getenv("QBITTORRENT_USER")
-    qb_pass = os.getenv("QBITTORRENT_PASS")
 
-    s = requests.Session()
-    login = s.post(f"{qb_host}/api/v2/auth/login", data={"username": qb_user, "password": qb_pass})
-    if login.status_code != 200 or login.text != "Ok.":
-        return jsonify({"error": "qBittorrent login failed"}), 500
+# helper function -> current state of a requested movie, as sent over /events
+def download_event(tmdb_id):
+    d = downloads.get(tmdb_id)
+    if d is None:
+        return {"id": tmdb_id, "status": "idle"}
 
-    torrents = s.get(f"{qb_host}/api/v2/torrents/info").json()
+    event = {"id": tmdb_id, "status": d["state"]}
+    if d["state"] == "downloading" and d["torrent_state"]:
+        event.update(progress=d["progress"], state=d["torrent_state"])
+    elif d["state"] == "failed":
+        event["error"] = d["error"]
+    return event
 
-    for torrent in torrents:
-        if normalize(movie_title) in normalize(torrent["name"]):
 
-            # Find matching tmdb_id for this title
-            tmdb_id = next((id for id, title in in_progress_downloads.items() if normalize(title["title"]) == normalize(movie_title)), None)
 
-            if torrent["progress"] >= 1.0:
-                if tmdb_id:
-                    completed_downloads.add(tmdb_id)
-                    in_progress_downloads.pop(tmdb_id, None)
+# server-sent events stream of progress/state changes for all of the user's requested movies
+@bp.route("/events")
+def events():
+    requested = [m["id"] for m in session.get("searched_movies", [])]
 
-                    # post-processing after download done
-                    base_path = os.path.join(current_app.config['MEDIA_PATH'], movie_title)
-                    finalize_movie_folder(base_path)
-                    download_poster_and_metadata(tmdb_id, base_path)
-                    search_and_download_subtitle(movie_title, base_path)
+    def stream():
+        last_sent = {}
+        version = None
+        deadline = time.monotonic() + EVENTS_MAX_DURATION
+        while time.monotonic() < deadline:
+            sent = False
+            for tmdb_id in requested:
+                event = download_event(tmdb_id)
+                if event != last_sent.get(tmdb_id):
+                    last_sent[tmdb_id] = event
+                    sent = True
+                    yield f"data: {json.dumps(event)}\n\n"
 
-            return jsonify({
-                "progress": torrent["progress"],
-                "state": torrent["state"]
-            })
+            new_version = downloads.wait_for_change(version, EVENTS_KEEPALIVE)
+            if new_version == version and not sent:
+                yield ": keepalive\n\n"
+            version = new_version
 
-    return jsonify({"error": "Torrent not found"}), 404
+    return Response(stream_with_context(stream()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 
-# returns current download state (idle, downloading, or completed) of requested movie from tmdb id
+# returns current request state (idle if never requested) of a movie from tmdb id
 @bp.route("/download_state/<int:tmdb_id>")
 def download_state(tmdb_id):
-    if tmdb_id in completed_downloads:
-        return jsonify({"state": "completed"})
-    elif tmdb_id in in_progress_downloads:
-        return jsonify({"state": "downloading"})
-    return jsonify({"state": "idle"})
+    d = downloads.get(tmdb_id)
+    return jsonify({"state": d["state"] if d else "idle", "error": d["error"] if d else None})
 
 
 
-# cancels requested download, removing it from qbitorrent, the requests session, and deleting the relevant directory
-@bp.route("/cancel_download/<int:tmdb_id>", methods=["POST"])
-def cancel_download(tmdb_id):
-    title = in_progress_downloads.get(tmdb_id)["title"]
-    if not title:
-        return jsonify({"error": "not in progress"}), 404
+# TMDb cache hit/miss counters
+@bp.route("/tmdb_stats")
+def tmdb_stats():
+    return jsonify(tmdb.stats())
+
+
+
+# per-indexer Jackett latency and failure counters, and which indexers are being skipped
+@bp.route("/jackett_stats")
+def jackett_stats():
+    return jsonify(jackett.indexer_stats())
 
-    # remove from qbittorrent
-    qb_host = os.getenv("QBITTORRENT_HOST")
-    qb_user = os.getenv("QBITTORRENT_USER")
-    qb_pass = os.getenv("QBITTORRENT_PASS")
 
-    s = requests.Session()
-    login = s.post(f"{qb_host}/api/v2/auth/login", data={"username": qb_user, "password": qb_pass})
-    if login.status_code != 200 or login.text != "Ok.":
-        return jsonify({"error": "login failed"}), 500
 
-    # get torrent hashes
-    info = s.get(f"{qb_host}/api/v2/torrents/info", params={"category": "media"})
-    torrents = info.json()
-    for torrent in torrents:
-        if normalize(title) in normalize(torrent["name"]):
-            hash_ = torrent["hash"]
-            s.post(f"{qb_host}/api/v2/torrents/delete", data={"hashes": hash_, "deleteFiles": "true"})
-            break
+# returns post-processing job status of requested movie from tmdb id
+@bp.route("/job_status/<int:tmdb_id>")
+def job_status(tmdb_id):
+    status = job_queue.status(post_process_key(tmdb_id))
+    if status is None:
+        return jsonify({"error": "No job for this movie"}), 404
+    return jsonify(status)
 
-    # Remove folder
-    media_path = os.path.join(current_app.config["MEDIA_PATH"], title)
-    if os.path.exists(media_path):
-        shutil.rmtree(media_path, ignore_errors=True)
 
-    in_progress_downloads.pop(tmdb_id, None)
+
+# cancels requested download, removing it from qbitorrent, the requests session, and deleting the relevant directory
+@bp.route("/cancel_download/<int:tmdb_id>", methods=["POST"])
+def cancel_download(tmdb_id):
+    d = downloads.get(tmdb_id)
+    if d is None:
+        session["searched_movies"] = [m for m in session.get("searched_movies", []) if m["id"] != tmdb_id]
+        session.modified = True
+        return jsonify({"error": "not requested"}), 404
+    if d["state"] == "ready":
+        return jsonify({"error": "not in progress"}), 404
+    title = d["title"]
+
+    # forgetting the request first stops a download job that's still searching from adding its torrent,
+    # and makes one that's adding it right now remove it again (the poller may not have seen it yet)
+    downloads.remove(tmdb_id)
+
+    if title:
+        # remove from qbittorrent
+        try:
+            torrent = torrent_poller.find(title)
+            if torrent and torrent.get("category") == "media":
+                qbittorrent.delete_torrents(torrent["hash"], delete_files=True)
+        except (QBittorrentError, requests.RequestException) as e:
+            current_app.logger.error(f"Failed to remove torrent for {title}: {e}")
+            return jsonify({"error": "qBittorrent request failed"}), 500
+
+        # Remove folder
+        media_path = os.path.join(current_app.config["MEDIA_PATH"], title)
+        if os.path.exists(media_path):
+            shutil.rmtree(media_path, ignore_errors=True)
+        library.remove(title)
+        disk_usage.invalidate(title)
+        transcoder.forget(title)
 
     # Remove from session
     session["searched_movies"] = [m for m in session.get("searched_movies", []) if m["id"] != tmdb_id]
@@ -312,21 +273,12 @@ def cancel_download(tmdb_id):
 
 
 
-# get media directory stats, namely file sizes
+# get media directory stats, namely file sizes, from the cached per-folder sizes (?refresh=1 re-walks everything)
 @bp.route("/controls_info")
 def controls_info():
-    media_path = current_app.config['MEDIA_PATH']
-    total_size = 0
-    folders = []
-
-    for folder in os.listdir(media_path):
-        folder_path = os.path.join(media_path, folder)
-        if os.path.isdir(folder_path):
-            size = sum(os.path.getsize(os.path.join(dp, f))
-                       for dp, dn, filenames in os.walk(folder_path)
-                       for f in filenames)
-            total_size += size
-            folders.append({"name": folder, "size": round(size / (1024 * 1024), 2)})
+    force = request.args.get("refresh") == "1"
+    total_size, sizes = disk_usage.usage(force=force)
+    folders = [{"name": name, "size": round(size / (1024 * 1024), 2)} for name, size in sizes]
 
     return jsonify({
         "total_size": round(total_size / (1024 * 1024), 2),  # in MB
@@ -351,21 +303,10 @@ def delete_folder(folder):
     folder_path = os.path.join(media_path, folder)
 
     # Remove matching torrent from qBittorrent
-    qb_host = os.getenv("QBITTORRENT_HOST")
-    qb_user = os.getenv("QBITTORRENT_USER")
-    qb_pass = os.getenv("QBITTORRENT_PASS")
-
     try:
-        s = requests.Session()
-        login = s.post(f"{qb_host}/api/v2/auth/login", data={"username": qb_user, "password": qb_pass})
-        if login.status_code == 200 and login.text == "Ok.":
-
-            torrents = s.get(f"{qb_host}/api/v2/torrents/info", params={"category": "media"}).json()
-            for torrent in torrents:
-                if folder.lower() in torrent["name"].lower():
-                    hash_ = torrent["hash"]
-                    s.post(f"{qb_host}/api/v2/torrents/delete", data={"hashes": hash_, "deleteFiles": "true"})
-                    break  # Stop after first match
+        torrent = torrent_poller.find(folder)
+        if torrent and torrent.get("category") == "media":
+            qbittorrent.delete_torrents(torrent["hash"], delete_files=True)
 
     except Exception as e:
         current_app.logger.warning(f"Failed to remove torrent for {folder}: {e}")
@@ -373,6 +314,11 @@ def delete_folder(folder):
     # Delete the folder
     if os.path.isdir(folder_path):
         shutil.rmtree(folder_path, ignore_errors=True)
+        library.remove(folder)
+        disk_usage.invalidate(folder)
+        downloads.remove_title(folder)
+        probe.forget(folder_path)
+        transcoder.forget(folder)
         return "", 204
 
     return "Folder not found", 404
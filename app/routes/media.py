@@ -1,7 +1,26 @@
-from flask import Blueprint, send_from_directory, current_app
+from flask import Blueprint, send_from_directory, current_app, abort
+from werkzeug.security import safe_join
+from ..streaming import serve_file, accel_redirect, MEDIA_SERVE_MODE
+from ..thumbnails import THUMBNAIL_DIR
+import os
 
 bp = Blueprint("media", __name__, url_prefix="/media")
 
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+
+# serves media files, either zero-copy through sendfile, handed off to nginx, or through flask (MEDIA_SERVE_MODE)
 @bp.route("/<path:filename>")
 def serve_media(filename):
-    return send_from_directory(current_app.config['MEDIA_PATH'], filename)
+    if MEDIA_SERVE_MODE == "flask":
+        response = send_from_directory(current_app.config['MEDIA_PATH'], filename)
+    else:
+        path = safe_join(current_app.config['MEDIA_PATH'], filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = accel_redirect(filename) if MEDIA_SERVE_MODE == "accel" else serve_file(path)
+
+    # thumbnail names are content hashed, so a url always means the same bytes
+    if os.path.basename(os.path.dirname(filename)) == THUMBNAIL_DIR:
+        response.headers["Cache-Control"] = IMMUTABLE
+    return response
@@ -1,13 +1,7 @@
-from flask import Blueprint, request, jsonify, current_app
-from ..utils import load_progress, save_progress
+from flask import Blueprint, request, jsonify, abort
+from ..progress_store import progress_store
 
 bp = Blueprint("progress", __name__)
-progress_data = {}
-
-@bp.before_app_first_request
-def load_user_progress():
-    global progress_data
-    progress_data = load_progress(current_app.config['PROGRESS_PATH'])
 
 @bp.route("/progress", methods=["GET", "POST"])
 def movie_progress():
@@ -17,14 +11,17 @@ def movie_progress():
 
     if request.method == "GET":
         movie = request.args.get("movie")
-        return jsonify({"time": progress_data.get(user, {}).get(movie, 0)})
+        return jsonify({"time": progress_store.get(user, movie)})
 
     data = request.get_json()
     movie, time = data["movie"], float(data["time"])
 
-    if user not in progress_data:
-        progress_data[user] = {}
-    progress_data[user][movie] = time
-    save_progress(current_app.config['PROGRESS_PATH'], progress_data)
+    # buffered, written to the shared state store by the progress store's flush thread
+    progress_store.set(user, movie, time)
 
     return jsonify({"status": "ok"})
+
+# flush latency / batch size counters, for tuning PROGRESS_FLUSH_INTERVAL
+@bp.route("/progress_stats")
+def progress_stats():
+    return jsonify(progress_store.stats())
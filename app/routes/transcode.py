@@ -0,0 +1,32 @@
+from flask import Blueprint, Response, current_app, abort
+from werkzeug.security import safe_join
+from ..transcoder import transcoder
+from ..packaging import find_movie_file
+from ..streaming import serve_file
+import os
+
+bp = Blueprint("transcode", __name__, url_prefix="/transcode")
+
+# helper function -> movie file of given movie folder, 404 if there isn't one
+def source_file(movie_name):
+    base_path = safe_join(current_app.config['MEDIA_PATH'], movie_name)
+    source = find_movie_file(base_path) if base_path and os.path.isdir(base_path) else None
+    if source is None:
+        abort(404)
+    return source
+
+# hls playlist of on-demand transcoded segments
+@bp.route("/<movie_name>/index.m3u8")
+def playlist(movie_name):
+    return Response(transcoder.playlist(source_file(movie_name)), mimetype="application/vnd.apple.mpegurl")
+
+# returns given segment, transcoding it first if it isn't cached
+@bp.route("/<movie_name>/seg_<int:index>.ts")
+def segment(movie_name, index):
+    try:
+        path = transcoder.segment(movie_name, source_file(movie_name), index)
+    except TimeoutError:
+        return "Segment not ready", 503
+    if path is None:
+        abort(404)
+    return serve_file(path)
@@ -0,0 +1,207 @@
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import threading
+import sqlite3
+import uuid
+import json
+import time
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")   # sqlite | redis
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+LOCK_POLL_INTERVAL = 0.05  # seconds between attempts at a held lock
+
+
+# state shared by every gunicorn worker, kept in sqlite in WAL mode so readers never block the writer:
+# json values in namespaces (like redis hashes), atomic read-modify-write updates, and expiring named locks
+class SQLiteState:
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()  # one connection per thread
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("CREATE TABLE IF NOT EXISTS kv (ns TEXT, key TEXT, value TEXT, PRIMARY KEY (ns, key))")
+        db.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, owner TEXT, expires REAL)")
+
+    def _db(self):
+        db = getattr(self.local, "db", None)
+        if db is None or self.local.pid != os.getpid():  # connections can't be shared with a forked worker
+            db = self.local.db = sqlite3.connect(self.path, timeout=30, isolation_level=None)  # autocommit
+            db.execute("PRAGMA synchronous=NORMAL")  # durable across crashes of the app, WAL keeps it consistent
+            self.local.pid = os.getpid()
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._db()
+        db.execute("BEGIN IMMEDIATE")  # takes the write lock up front, so read-modify-write can't interleave
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def get(self, ns, key):
+        row = self._db().execute("SELECT value FROM kv WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    # every key -> value in a namespace
+    def items(self, ns):
+        rows = self._db().execute("SELECT key, value FROM kv WHERE ns = ?", (ns,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def set(self, ns, key, value):
+        self.set_many(ns, {key: value})
+
+    # writes several keys in one transaction
+    def set_many(self, ns, mapping):
+        with self._transaction() as db:
+            db.executemany("INSERT OR REPLACE INTO kv (ns, key, value) VALUES (?, ?, ?)",
+                           [(ns, key, json.dumps(value)) for key, value in mapping.items()])
+
+    def delete(self, ns, key):
+        self._db().execute("DELETE FROM kv WHERE ns = ? AND key = ?", (ns, key))
+
+    # atomically replaces a key's value with fn(current value, None if unset), fn returns None to leave it as is,
+    # returns the value written, or None if nothing was
+    def update(self, ns, key, fn):
+        with self._transaction() as db:
+            row = db.execute("SELECT value FROM kv WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+            value = fn(json.loads(row[0]) if row else None)
+            if value is not None:
+                db.execute("INSERT OR REPLACE INTO kv (ns, key, value) VALUES (?, ?, ?)", (ns, key, json.dumps(value)))
+        return value
+
+    # update() for several keys in one transaction, fn(current value, new value) returns what to write or None
+    def merge_many(self, ns, mapping, fn):
+        with self._transaction() as db:
+            for key, new in mapping.items():
+                row = db.execute("SELECT value FROM kv WHERE ns = ? AND key = ?", (ns, key)).fetchone()
+                value = fn(json.loads(row[0]) if row else None, new)
+                if value is not None:
+                    db.execute("INSERT OR REPLACE INTO kv (ns, key, value) VALUES (?, ?, ?)", (ns, key, json.dumps(value)))
+
+    # tries to take a named lock held for at most ttl seconds, returns its owner token, None if it's held
+    def _acquire(self, name, ttl):
+        token = uuid.uuid4().hex
+        now = time.time()
+        with self._transaction() as db:
+            row = db.execute("SELECT expires FROM locks WHERE name = ?", (name,)).fetchone()
+            if row and row[0] > now:
+                return None
+            db.execute("INSERT OR REPLACE INTO locks (name, owner, expires) VALUES (?, ?, ?)", (name, token, now + ttl))
+        return token
+
+    def _release(self, name, token):
+        self._db().execute("DELETE FROM locks WHERE name = ? AND owner = ?", (name, token))
+
+    # cross-worker lock, yields whether it was acquired (always True when blocking),
+    # it expires after ttl seconds so a worker that dies holding it can't wedge the others
+    @contextmanager
+    def lock(self, name, ttl=30, blocking=True):
+        token = self._acquire(name, ttl)
+        while token is None and blocking:
+            time.sleep(LOCK_POLL_INTERVAL)
+            token = self._acquire(name, ttl)
+        try:
+            yield token is not None
+        finally:
+            if token:
+                self._release(name, token)
+
+
+# the same state in redis, for running workers on more than one machine, needs the redis package
+class RedisState:
+    def __init__(self, url):
+        import redis
+        self.redis = redis
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, ns, key):
+        value = self.client.hget(ns, key)
+        return json.loads(value) if value is not None else None
+
+    def items(self, ns):
+        return {key.decode(): json.loads(value) for key, value in self.client.hgetall(ns).items()}
+
+    def set(self, ns, key, value):
+        self.client.hset(ns, key, json.dumps(value))
+
+    def set_many(self, ns, mapping):
+        if mapping:
+            self.client.hset(ns, mapping={key: json.dumps(value) for key, value in mapping.items()})
+
+    def delete(self, ns, key):
+        self.client.hdel(ns, key)
+
+    # optimistic read-modify-write, retried whenever another worker changes the namespace in between
+    def update(self, ns, key, fn):
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(ns)
+                    current = pipe.hget(ns, key)
+                    value = fn(json.loads(current) if current is not None else None)
+                    pipe.multi()
+                    if value is not None:
+                        pipe.hset(ns, key, json.dumps(value))
+                    pipe.execute()
+                    return value
+                except self.redis.WatchError:
+                    continue
+
+    def merge_many(self, ns, mapping, fn):
+        if not mapping:
+            return
+        keys = list(mapping)
+        with self.client.pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(ns)
+                    current = pipe.hmget(ns, keys)
+                    values = {key: fn(json.loads(old) if old is not None else None, mapping[key])
+                              for key, old in zip(keys, current)}
+                    pipe.multi()
+                    writes = {key: json.dumps(value) for key, value in values.items() if value is not None}
+                    if writes:
+                        pipe.hset(ns, mapping=writes)
+                    pipe.execute()
+                    return
+                except self.redis.WatchError:
+                    continue
+
+    @contextmanager
+    def lock(self, name, ttl=30, blocking=True):
+        lock = self.client.lock(f"lock:{name}", timeout=ttl)
+        acquired = lock.acquire(blocking=blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                try:
+                    lock.release()
+                except self.redis.exceptions.LockError:
+                    pass  # expired while held
+
+
+# the app's shared state, backed by sqlite or redis (STATE_BACKEND), everything else goes through this
+class StateStore:
+    def __init__(self):
+        self.backend = None
+
+    def init_app(self, app):
+        if STATE_BACKEND == "redis":
+            self.backend = RedisState(REDIS_URL)
+        else:
+            self.backend = SQLiteState(app.config['STATE_DB_PATH'])
+        app.logger.info(f"Using {type(self.backend).__name__} for shared state")
+
+    def __getattr__(self, name):
+        if self.backend is None:
+            raise RuntimeError("State store used before init_app")
+        return getattr(self.backend, name)
+
+
+state = StateStore()
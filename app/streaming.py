@@ -0,0 +1,448 @@
+from .probe import cached as cached_probe
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.http import http_date, parse_date
+from flask import Response, request
+from collections import OrderedDict
+from urllib.parse import quote
+from dotenv import load_dotenv
+import subprocess
+import mimetypes
+import threading
+import requests
+import click
+import time
+import sys
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+MEDIA_SERVE_MODE = os.getenv("MEDIA_SERVE_MODE", "sendfile")                # sendfile | accel | flask
+MEDIA_ACCEL_PREFIX = os.getenv("MEDIA_ACCEL_PREFIX", "/protected_media/")   # nginx internal location
+CHUNK_SIZE = int(os.getenv("MEDIA_CHUNK_KB", 1024)) * 1024                      # per read from disk/sendfile
+MEDIA_READAHEAD = int(os.getenv("MEDIA_READAHEAD_MB", 8)) * 1024 * 1024         # asked of the kernel past a seek
+MEDIA_HOT_CACHE_BYTES = int(os.getenv("MEDIA_HOT_CACHE_MB", 32)) * 1024 * 1024  # in-memory hot ranges, per worker
+MEDIA_HOT_SECONDS = float(os.getenv("MEDIA_HOT_SECONDS", 10))                   # of each title read ahead
+HOT_HEAD_BYTES = (1024 * 1024, 8 * 1024 * 1024)  # bounds on the start of a title read ahead
+HOT_MOOV_MAX = 16 * 1024 * 1024  # bigger moov atoms aren't worth holding in memory
+HOT_MIN_FILE = 64 * 1024 * 1024  # smaller files (hls segments, posters) are left to the page cache
+MP4_EXTENSIONS = (".mp4", ".m4v", ".mov")
+
+mimetypes.add_type("application/vnd.apple.mpegurl", ".m3u8")
+mimetypes.add_type("video/iso.segment", ".m4s")
+mimetypes.add_type("video/x-matroska", ".mkv")
+
+
+# parses a Range header into a list of inclusive (start, end) byte ranges within size,
+# None if there is no usable header, [] if no range is satisfiable
+def parse_ranges(header, size):
+    if not header or not header.startswith("bytes="):
+        return None
+    ranges = []
+    for spec in header[6:].split(","):
+        start, sep, end = spec.strip().partition("-")
+        if not sep:
+            return None
+        try:
+            if start:
+                start, end = int(start), int(end) if end else None
+            else:
+                start, end = max(size - int(end), 0), None  # suffix range, last n bytes
+        except ValueError:
+            return None
+        if end is not None and start > end:
+            return None
+        if start < size:
+            ranges.append((start, size - 1 if end is None else min(end, size - 1)))
+    return ranges
+
+
+# whether an If-Range header still matches the file, so the Range header should be honoured
+def if_range_matches(if_range, etag, mtime):
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    date = parse_date(if_range)
+    return date is not None and int(mtime) <= date.timestamp()
+
+
+# whether the client's cached copy is still current
+def not_modified(etag, mtime):
+    if_none_match = request.headers.get("If-None-Match")
+    if if_none_match:
+        return etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    since = parse_date(request.headers.get("If-Modified-Since"))
+    return since is not None and int(mtime) <= since.timestamp()
+
+
+# yields length bytes of f from offset, in chunks
+def read_range(f, offset, length):
+    while length > 0:
+        chunk = os.pread(f.fileno(), min(CHUNK_SIZE, length), offset)
+        if not chunk:
+            break
+        offset += len(chunk)
+        length -= len(chunk)
+        yield chunk
+
+
+# asks the kernel to read ahead aggressively from offset, since playback reads on sequentially from a seek,
+# a no-op where posix_fadvise isn't available
+def advise(fd, offset, length=MEDIA_READAHEAD):
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+
+
+# yields (box type, offset, size) of the top-level boxes of an mp4 file
+def top_level_boxes(fd, size):
+    offset = 0
+    while offset + 8 <= size:
+        header = os.pread(fd, 16, offset)
+        if len(header) < 8:
+            return
+        box_size, box_type = int.from_bytes(header[:4], "big"), header[4:8].decode("latin-1")
+        if box_size == 1 and len(header) == 16:
+            box_size = int.from_bytes(header[8:16], "big")  # 64-bit size
+        elif box_size == 0:
+            box_size = size - offset  # runs to the end of the file
+        if box_size < 8:
+            return  # not an mp4, or a corrupt one
+        yield box_type, offset, box_size
+        offset += box_size
+
+
+# small per-worker cache of the byte ranges a player asks for first, filled in the background the first time a title
+# is served or its page is opened: the start of each title is read ahead into the page cache (the player opens with
+# bytes=0-, which is left to sendfile), and an mp4 moov atom at the end of the file (a far seek on a usb disk before
+# anything can play, and asked for whole) is held in memory, within MEDIA_HOT_CACHE_BYTES, least recently used titles
+# dropped first
+class HotRanges:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = OrderedDict()   # (path, mtime_ns, size) -> [(start, bytes)]
+        self.bytes = 0
+        self.loading = set()
+        self.pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="hot-ranges")
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _key(path, st):
+        return path, st.st_mtime_ns, st.st_size
+
+    # cached length bytes of the file from start, None unless one hot range holds all of them
+    def get(self, path, st, start, length):
+        key = self._key(path, st)
+        with self.lock:
+            ranges = self.files.get(key)
+            if ranges is not None:
+                self.files.move_to_end(key)
+                for offset, data in ranges:
+                    if offset <= start and start + length <= offset + len(data):
+                        self.hits += 1
+                        return data[start - offset:start - offset + length]
+            self.misses += 1
+        if ranges is None:
+            self.warm(path, st)
+        return None
+
+    # loads a title's hot ranges in the background unless they're cached or it's too small to bother with
+    def warm(self, path, st=None):
+        st = st or os.stat(path)
+        key = self._key(path, st)
+        if st.st_size < HOT_MIN_FILE:
+            return
+        with self.lock:
+            if key in self.files or key in self.loading:
+                return
+            self.loading.add(key)
+        self.pool.submit(self._load, path, st, key)
+
+    # (offset, length) of the ranges worth warming for a file: its first seconds, and the moov atom if it's an mp4
+    def _ranges(self, path, fd, st):
+        summary = cached_probe(st)
+        head = HOT_HEAD_BYTES[0]
+        if summary and summary.get("bit_rate"):
+            head = min(max(int(summary["bit_rate"] / 8 * MEDIA_HOT_SECONDS), HOT_HEAD_BYTES[0]), HOT_HEAD_BYTES[1])
+        ranges = [(0, min(head, st.st_size))]
+        if path.lower().endswith(MP4_EXTENSIONS):
+            moov = next(((offset, size) for box, offset, size in top_level_boxes(fd, st.st_size) if box == "moov"), None)
+            if moov and moov[1] <= HOT_MOOV_MAX and moov[0] >= head:
+                ranges.append(moov)
+        return ranges
+
+    def _load(self, path, st, key):
+        try:
+            with open(path, "rb") as f:
+                ranges = []
+                for offset, length in self._ranges(path, f.fileno(), st):
+                    advise(f.fileno(), offset, length)
+                    if offset:  # the head only goes to the page cache
+                        ranges.append((offset, os.pread(f.fileno(), length, offset)))
+        except OSError:
+            ranges = None
+        with self.lock:
+            self.loading.discard(key)
+            if ranges is None:
+                return
+            self.files[key] = ranges
+            self.bytes += sum(len(data) for _, data in ranges)
+            while self.bytes > MEDIA_HOT_CACHE_BYTES and len(self.files) > 1:
+                _, dropped = self.files.popitem(last=False)
+                self.bytes -= sum(len(data) for _, data in dropped)
+
+    def clear(self):
+        with self.lock:
+            self.files.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            return {"files": len(self.files), "bytes": self.bytes, "hits": self.hits, "misses": self.misses}
+
+
+hot_ranges = HotRanges()
+
+
+# gets a title ready to play from given second (e.g. where the viewer left off): its hot ranges are loaded,
+# and the kernel starts reading around the resume point, whose offset is estimated from the probed bitrate
+def prefetch(path, resume_at=0):
+    try:
+        st = os.stat(path)
+        hot_ranges.warm(path, st)
+        summary = cached_probe(st)
+        if resume_at and summary and summary.get("bit_rate"):
+            offset = min(int(resume_at * summary["bit_rate"] / 8), st.st_size)
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                advise(fd, max(offset - MEDIA_READAHEAD // 4, 0))  # a little before, the estimate is rough
+            finally:
+                os.close(fd)
+    except OSError:
+        pass
+
+
+# file body from offset to the end of the file, through the server's wsgi.file_wrapper when it has one,
+# which lets gunicorn hand the file straight to the socket with sendfile(2)
+def file_body(f, offset):
+    f.seek(offset)
+    file_wrapper = request.environ.get("wsgi.file_wrapper")
+    if file_wrapper:
+        return file_wrapper(f, CHUNK_SIZE)
+    return _closing(iter(lambda: f.read(CHUNK_SIZE), b""), f)
+
+
+# part headers of a multipart/byteranges body for several ranges, returning (parts, content length)
+def multipart_parts(ranges, size, content_type, boundary):
+    parts = []
+    for start, end in ranges:
+        head = (f"--{boundary}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Range: bytes {start}-{end}/{size}\r\n\r\n").encode()
+        parts.append((head, start, end - start + 1))
+    length = sum(len(head) + n + 2 for head, _, n in parts) + len(f"--{boundary}--\r\n")
+    return parts, length
+
+
+def multipart_body(f, parts, boundary):
+    for head, start, n in parts:
+        yield head
+        yield from read_range(f, start, n)
+        yield b"\r\n"
+    yield f"--{boundary}--\r\n".encode()
+
+
+# hands the file to nginx, which then serves it (ranges, validators and all) from its internal location
+def accel_redirect(filename):
+    response = Response(status=200)
+    response.headers["X-Accel-Redirect"] = MEDIA_ACCEL_PREFIX + quote(filename)
+    response.headers["Content-Type"] = ""  # let nginx set it from the file extension
+    return response
+
+
+# serves a file with full range support: single and multiple ranges, ETag/Last-Modified validators and If-Range
+def serve_file(path):
+    st = os.stat(path)
+    size, mtime = st.st_size, st.st_mtime
+    etag = f'"{st.st_mtime_ns:x}-{size:x}"'
+    content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+    headers = {
+        "Accept-Ranges": "bytes",
+        "ETag": etag,
+        "Last-Modified": http_date(mtime),
+        "Content-Type": content_type
+    }
+
+    ranges = None
+    if if_range_matches(request.headers.get("If-Range"), etag, mtime):
+        ranges = parse_ranges(request.headers.get("Range"), size)
+
+    if ranges is None and not_modified(etag, mtime):
+        return Response(status=304, headers=headers)
+    if ranges == []:
+        headers["Content-Range"] = f"bytes */{size}"
+        return Response(status=416, headers=headers)
+
+    if ranges is None or len(ranges) == 1:
+        status, (start, end) = (200, (0, size - 1)) if ranges is None else (206, ranges[0])
+        if ranges is not None:
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+        headers["Content-Length"] = str(end - start + 1)
+        length = end - start + 1
+
+        # ranges held whole in memory skip the disk, anything longer goes through sendfile below
+        hot = hot_ranges.get(path, st, start, length) if request.method != "HEAD" else None
+        if hot is not None:
+            return Response([hot], status=status, headers=headers, direct_passthrough=True)
+        if end == size - 1:
+            return _response(status, headers, lambda f: file_body(f, start), path, start)
+        return _response(status, headers, lambda f: _closing(read_range(f, start, length), f), path, start)
+
+    boundary = os.urandom(12).hex()
+    parts, length = multipart_parts(ranges, size, content_type, boundary)
+    headers["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    headers["Content-Length"] = str(length)
+    return _response(206, headers, lambda f: _closing(multipart_body(f, parts, boundary), f), path, ranges[0][0])
+
+
+# builds the response, only opening the file when there's a body to send, with read-ahead from offset
+def _response(status, headers, make_body, path, offset=0):
+    if request.method == "HEAD":
+        return Response(status=status, headers=headers)
+    f = open(path, "rb")
+    advise(f.fileno(), offset)
+    return Response(make_body(f), status=status, headers=headers, direct_passthrough=True)
+
+
+# closes f once the generator is exhausted or abandoned
+def _closing(gen, f):
+    try:
+        yield from gen
+    finally:
+        f.close()
+
+
+# cpu seconds a process has used so far, from /proc
+def _cpu_seconds(pid):
+    with open(f"/proc/{pid}/stat") as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")  # utime + stime
+
+
+# downloads url whole rounds times and makes seeks 4MB range requests spread through it,
+# returns (full download MB/s, average ms per range request)
+def _measure_serving(url, size, rounds, seeks):
+    start, received = time.perf_counter(), 0
+    for _ in range(rounds):
+        with requests.get(url, stream=True, timeout=60) as r:
+            r.raise_for_status()
+            for chunk in r.iter_content(CHUNK_SIZE):
+                received += len(chunk)
+    throughput = received / 1024 ** 2 / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    for i in range(seeks):
+        offset = size * i // max(seeks, 1)
+        requests.get(url, headers={"Range": f"bytes={offset}-{offset + 4 * 1024 * 1024 - 1}"}, timeout=60).content
+    return throughput, (time.perf_counter() - start) * 1000 / max(seeks, 1)
+
+
+def init_app(app):
+    # flask bench-streaming <movie> [--seeks n], time to first byte of range requests for a movie's file,
+    # cold (hot ranges and page cache dropped) and warm, at the start and spread through the file
+    @app.cli.command("bench-streaming")
+    @click.argument("movie")
+    @click.option("--seeks", default=4, help="Seek points spread through the file, besides its start.")
+    def bench_streaming(movie, seeks):
+        from .packaging import find_movie_file
+        path = find_movie_file(os.path.join(app.config['MEDIA_PATH'], movie))
+        if path is None:
+            raise click.ClickException(f"No movie file in {movie}")
+        size = os.path.getsize(path)
+        offsets = [0] + [size * i // (seeks + 1) for i in range(1, seeks + 1)]
+        url = f"/media/{movie}/{os.path.basename(path)}"
+        client = app.test_client()
+
+        def ttfb(offset):
+            start = time.perf_counter()
+            response = client.get(url, headers={"Range": f"bytes={offset}-"}, buffered=False)
+            next(iter(response.response))
+            elapsed = (time.perf_counter() - start) * 1000
+            response.close()
+            return elapsed
+
+        def drop_caches():
+            hot_ranges.clear()
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            finally:
+                os.close(fd)
+
+        click.echo(f"{path} ({size / 1024 ** 2:.0f}MB), chunk {CHUNK_SIZE // 1024}KB, "
+                   f"readahead {MEDIA_READAHEAD // 1024 ** 2}MB")
+        click.echo(f"{'offset':>14} {'cold ms':>9} {'warm ms':>9}")
+        for offset in offsets:
+            drop_caches()
+            cold = ttfb(offset)
+            prefetch(path)
+            deadline = time.monotonic() + 10
+            while not hot_ranges.stats()["files"] and time.monotonic() < deadline:
+                time.sleep(0.01)  # the load queued by the cold request
+            warm = ttfb(offset)
+            click.echo(f"{offset:>14} {cold:>9.2f} {warm:>9.2f}")
+        click.echo(f"hot ranges: {hot_ranges.stats()}")
+
+    # flask bench-serving <movie> [--rounds n] [--seeks n] [--accel-url url], media throughput of the old
+    # send_from_directory path (MEDIA_SERVE_MODE=flask) against sendfile, each served by a one worker gunicorn started
+    # for it, with the cpu the worker spent per GB, and of X-Accel-Redirect through an nginx already in front of the app
+    @app.cli.command("bench-serving")
+    @click.argument("movie")
+    @click.option("--rounds", default=3, help="Full downloads of the file per mode.")
+    @click.option("--seeks", default=20, help="4MB range requests spread through the file per mode.")
+    @click.option("--accel-url", default=None, help="Base url of an nginx proxying the app in accel mode.")
+    @click.option("--port", default=8765, help="Port for the gunicorn started for each mode.")
+    def bench_serving(movie, rounds, seeks, accel_url, port):
+        from .packaging import find_movie_file
+        path = find_movie_file(os.path.join(app.config['MEDIA_PATH'], movie))
+        if path is None:
+            raise click.ClickException(f"No movie file in {movie}")
+        size = os.path.getsize(path)
+        media_url = f"/media/{quote(movie)}/{quote(os.path.basename(path))}"
+        click.echo(f"{path} ({size / 1024 ** 2:.0f}MB), {rounds} full download(s) and {seeks} range request(s) per mode")
+        click.echo(f"{'mode':>9} {'MB/s':>9} {'ms/range':>9} {'cpu s/GB':>9}")
+
+        for mode in ("flask", "sendfile"):
+            server = subprocess.Popen(
+                [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", "1",
+                 "--worker-class", "gthread", "--threads", "4", "app:create_app()"],
+                cwd=os.path.dirname(app.root_path), env=dict(os.environ, MEDIA_SERVE_MODE=mode, BACKGROUND_WORKERS="0"),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                url = f"http://127.0.0.1:{port}{media_url}"
+                deadline = time.monotonic() + 60
+                while True:
+                    try:
+                        requests.get(url, headers={"Range": "bytes=0-0"}, timeout=5).raise_for_status()
+                        break
+                    except requests.RequestException:
+                        if time.monotonic() > deadline or server.poll() is not None:
+                            raise click.ClickException(f"gunicorn didn't come up in {mode} mode")
+                        time.sleep(0.5)
+                with open(f"/proc/{server.pid}/task/{server.pid}/children") as f:
+                    worker = int(f.read().split()[0])
+                cpu = _cpu_seconds(worker)
+                throughput, per_range = _measure_serving(url, size, rounds, seeks)
+                cpu_per_gb = (_cpu_seconds(worker) - cpu) / ((size * rounds + seeks * 4 * 1024 ** 2) / 1024 ** 3)
+                click.echo(f"{mode:>9} {throughput:>9.1f} {per_range:>9.2f} {cpu_per_gb:>9.3f}")
+            finally:
+                server.terminate()
+                server.wait()
+
+        if accel_url:
+            throughput, per_range = _measure_serving(accel_url.rstrip("/") + media_url, size, rounds, seeks)
+            click.echo(f"{'accel':>9} {throughput:>9.1f} {per_range:>9.2f} {'nginx':>9}")
+        else:
+            click.echo("accel skipped, pass --accel-url with the url of an nginx proxying the app in accel mode")
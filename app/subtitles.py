@@ -0,0 +1,266 @@
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from flask import current_app
+import subprocess
+import statistics
+import tempfile
+import requests
+import codecs
+import shutil
+import struct
+import click
+import time
+import re
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+OPENSUBTITLES_API_KEY = os.getenv("OPENSUBTITLES_API_KEY")
+OPENSUBTITLES_URL = "https://api.opensubtitles.com/api/v1"
+SUBTITLE_LANGUAGES = [lang.strip() for lang in os.getenv("SUBTITLE_LANGUAGES", "en").split(",") if lang.strip()]
+LANGUAGE_NAMES = {
+    "en": "English", "es": "Spanish", "fr": "French", "de": "German", "it": "Italian", "pt": "Portuguese",
+    "nl": "Dutch", "ru": "Russian", "ja": "Japanese", "ko": "Korean", "zh": "Chinese", "ar": "Arabic",
+    "hi": "Hindi", "tr": "Turkish", "pl": "Polish", "sv": "Swedish"
+}
+HASH_CHUNK = 64 * 1024
+
+TIMING = re.compile(r"(?:(\d+):)?(\d{1,2}):(\d{1,2})[,.](\d{1,3})\s*-->\s*(?:(\d+):)?(\d{1,2}):(\d{1,2})[,.](\d{1,3})")
+OVERRIDE_TAGS = re.compile(r"\{\\[^}]*\}")  # {\an8} style positioning tags some srt files carry over from ass
+SAMPLE_SIZE = 64 * 1024
+
+
+# guesses a subtitle file's encoding from its BOM, else whether its start decodes as utf-8, else cp1252
+def detect_encoding(path):
+    with open(path, "rb") as f:
+        sample = f.read(SAMPLE_SIZE)
+    if sample.startswith(codecs.BOM_UTF8):
+        return "utf-8-sig"
+    if sample.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return "utf-16"
+    try:
+        codecs.getincrementaldecoder("utf-8")().decode(sample, final=False)
+        return "utf-8"
+    except UnicodeDecodeError:
+        return "cp1252"
+
+
+def _seconds(h, m, s, ms):
+    return int(h or 0) * 3600 + int(m) * 60 + int(s) + int(ms.ljust(3, "0")) / 1000
+
+
+def _timestamp(seconds):
+    ms = round(seconds * 1000)
+    return f"{ms // 3600000:02}:{ms // 60000 % 60:02}:{ms // 1000 % 60:02}.{ms % 1000:03}"
+
+
+# yields (start, end, text lines) for every cue in an srt file, one line at a time
+def parse_srt(lines):
+    timing, text = None, []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        match = TIMING.search(line) if timing is None else None
+        if match:
+            g = match.groups()
+            timing = (_seconds(*g[:4]), _seconds(*g[4:]))
+        elif timing is not None and line.strip():
+            text.append(line)
+        elif timing is not None:
+            yield timing[0], timing[1], text
+            timing, text = None, []
+        # anything else is a cue number or stray blank line
+    if timing is not None:
+        yield timing[0], timing[1], text
+
+
+# writes srt cues out as webvtt, shifting them by offset seconds, returns number of cues written
+def write_vtt(cues, out, offset=0.0):
+    out.write("WEBVTT\n\n")
+    count = 0
+    for start, end, text in cues:
+        start, end = start + offset, end + offset
+        if end <= 0:
+            continue
+        text = [OVERRIDE_TAGS.sub("", line).replace("-->", "->") for line in text]
+        out.write(f"{_timestamp(max(start, 0))} --> {_timestamp(end)}\n" + "\n".join(text) + "\n\n")
+        count += 1
+    return count
+
+
+# converts an srt file to vtt in-process, returns the number of cues converted, the vtt is only written if there were any
+def srt_to_vtt(srt_path, vtt_path, offset=0.0):
+    tmp_path = f"{vtt_path}.tmp"
+    with open(srt_path, encoding=detect_encoding(srt_path), errors="replace", newline="") as src, \
+            open(tmp_path, "w", encoding="utf-8") as out:
+        count = write_vtt(parse_srt(src), out, offset)
+    if count:
+        os.replace(tmp_path, vtt_path)
+    else:
+        os.remove(tmp_path)
+    return count
+
+
+# converts any subtitle format ffmpeg understands (ass/ssa etc.) to vtt
+def ffmpeg_to_vtt(path, vtt_path, offset=0.0):
+    args = ["ffmpeg", "-y", "-v", "error"]
+    if offset:
+        args += ["-itsoffset", str(offset)]
+    subprocess.run(args + ["-i", path, vtt_path], check=True)
+
+
+# converts a subtitle file to vtt next to it, in-process for srt and through ffmpeg for anything else,
+# always removing the source file, returns the vtt path or None on failure
+def convert_to_vtt(path, offset=0.0, vtt_path=None):
+    vtt_path = vtt_path or os.path.splitext(path)[0] + ".vtt"
+    try:
+        if path.lower().endswith(".srt") and srt_to_vtt(path, vtt_path, offset):
+            return vtt_path
+        ffmpeg_to_vtt(path, vtt_path, offset)  # not srt, or not an srt we could parse
+        return vtt_path
+    except (OSError, subprocess.CalledProcessError) as e:
+        current_app.logger.warning(f"Failed to convert subtitle {path}: {e}")
+        return None
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+
+# opensubtitles movie hash: file size plus the 64-bit little-endian word sums of the first and last 64KB
+def movie_hash(path):
+    size = os.path.getsize(path)
+    if size < HASH_CHUNK * 2:
+        return None
+    total = size
+    with open(path, "rb") as f:
+        for offset in (0, size - HASH_CHUNK):
+            f.seek(offset)
+            total += sum(struct.unpack(f"<{HASH_CHUNK // 8}Q", f.read(HASH_CHUNK)))
+    return f"{total & 0xFFFFFFFFFFFFFFFF:016x}"
+
+
+def _headers():
+    return {"Api-Key": OPENSUBTITLES_API_KEY, "User-Agent": "home server"}
+
+
+# best subtitle file id for a movie in one language: a release whose hash matches the video file if there
+# is one (those are in sync with it), else the most downloaded, searching by tmdb id and then by title
+def _best_file_id(tmdb_id, movie_title, lang, file_hash, timeout):
+    searches = [{"tmdb_id": tmdb_id, **({"moviehash": file_hash} if file_hash else {})}, {"query": movie_title}]
+    for params in searches:
+        response = requests.get(f"{OPENSUBTITLES_URL}/subtitles", headers=_headers(), timeout=timeout, params={
+            **params, "languages": lang, "order_by": "download_count", "order_direction": "desc"
+        })
+        response.raise_for_status()
+        results = [r for r in response.json().get("data", []) if r["attributes"].get("files")]
+        if results:
+            best = next((r for r in results if r["attributes"].get("moviehash_match")), results[0])
+            return best["attributes"]["files"][0]["file_id"]
+    return None
+
+
+# downloads a subtitle file to given path, without its extension, returns the full path it was saved to
+def _download(file_id, path, timeout):
+    r = requests.post(f"{OPENSUBTITLES_URL}/download", headers=_headers(), json={"file_id": file_id}, timeout=timeout)
+    r.raise_for_status()
+    data = r.json()
+    if not data.get("link"):
+        raise RuntimeError(f"No download link for subtitle file {file_id}: {data}")
+
+    ext = os.path.splitext(data.get("file_name") or "")[1].lower() or ".srt"
+    sub_response = requests.get(data["link"], timeout=timeout)
+    sub_response.raise_for_status()
+    with open(path + ext, "wb") as f:
+        f.write(sub_response.content)
+    return path + ext
+
+
+# fetches one language's subtitles into the movie folder as subtitles.<lang>.vtt, from the subtitle cache when
+# this exact video file (or title, without one) has been fetched before, returns whether there are subtitles
+def fetch_language(tmdb_id, movie_title, base_path, lang, file_hash, cache_path, timeout=None):
+    cache_dir = os.path.join(cache_path, str(tmdb_id))
+    cached_vtt = os.path.join(cache_dir, f"{lang}-{file_hash or 'nohash'}.vtt")
+    if not os.path.exists(cached_vtt):
+        file_id = _best_file_id(tmdb_id, movie_title, lang, file_hash, timeout)
+        if file_id is None:
+            current_app.logger.info(f"No {lang} subtitles found for movie: {movie_title}")
+            return False
+        os.makedirs(cache_dir, exist_ok=True)
+        sub_path = _download(file_id, os.path.join(cache_dir, f"{lang}-{file_hash or 'nohash'}.download"), timeout)
+        if convert_to_vtt(sub_path, vtt_path=cached_vtt) is None:
+            return False
+
+    shutil.copyfile(cached_vtt, os.path.join(base_path, f"subtitles.{lang}.vtt"))
+    current_app.logger.info(f"Subtitles ({lang}) saved to: {base_path}")
+    return True
+
+
+# fetches subtitles for every configured language in parallel, matched to the video file's movie_hash if it has one,
+# returns the languages that now have subtitles
+def fetch_subtitles(tmdb_id, movie_title, base_path, file_hash, cache_path, languages=None, timeout=None):
+    languages = languages or SUBTITLE_LANGUAGES
+    if not languages:
+        return []
+    app = current_app._get_current_object()
+
+    def fetch(lang):
+        with app.app_context():
+            try:
+                return fetch_language(tmdb_id, movie_title, base_path, lang, file_hash, cache_path, timeout)
+            except (requests.RequestException, RuntimeError, ValueError, KeyError, OSError) as e:
+                current_app.logger.warning(f"Failed to fetch {lang} subtitles for {movie_title}: {e}")
+                return False
+
+    with ThreadPoolExecutor(max_workers=len(languages), thread_name_prefix="subtitles") as pool:
+        fetched = list(pool.map(fetch, languages))
+    return [lang for lang, ok in zip(languages, fetched) if ok]
+
+
+# (language, label, file name) of every subtitle track in a movie folder, configured languages first,
+# a plain subtitles.vtt from before per-language subtitles counts as english
+def subtitle_tracks(base_path):
+    tracks = {}
+    for name in os.listdir(base_path) if os.path.isdir(base_path) else []:
+        parts = name.split(".")
+        if parts[0] == "subtitles" and parts[-1] == "vtt" and len(parts) <= 3:
+            lang = parts[1] if len(parts) == 3 else "en"
+            if len(parts) == 3 or lang not in tracks:
+                tracks[lang] = name
+    order = {lang: i for i, lang in enumerate(SUBTITLE_LANGUAGES)}
+    langs = sorted(tracks, key=lambda lang: (order.get(lang, len(order)), lang))
+    return [(lang, LANGUAGE_NAMES.get(lang, lang.upper()), tracks[lang]) for lang in langs]
+
+
+def init_app(app):
+    # flask bench-subtitles <corpus> [--repeat n], srt -> vtt conversion latency over a folder of .srt files,
+    # in-process against the ffmpeg subprocess it replaced, the sources are left untouched
+    @app.cli.command("bench-subtitles")
+    @click.argument("corpus", type=click.Path(exists=True, file_okay=False))
+    @click.option("--repeat", default=5, help="Conversions of each file per method.")
+    def bench_subtitles(corpus, repeat):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(corpus)
+                       for name in names if name.lower().endswith(".srt"))
+        if not paths:
+            raise click.ClickException(f"No .srt files in {corpus}")
+        timings = {"in-process": [], "ffmpeg": []}
+        cues = 0
+        with tempfile.TemporaryDirectory() as tmp:
+            vtt_path = os.path.join(tmp, "out.vtt")
+            for path in paths:
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    count = srt_to_vtt(path, vtt_path)
+                    timings["in-process"].append((time.perf_counter() - start) * 1000)
+                    start = time.perf_counter()
+                    try:
+                        ffmpeg_to_vtt(path, vtt_path)
+                    except (OSError, subprocess.CalledProcessError) as e:
+                        raise click.ClickException(f"ffmpeg failed on {path}: {e}")
+                    timings["ffmpeg"].append((time.perf_counter() - start) * 1000)
+                cues += count
+
+        click.echo(f"{len(paths)} file(s), {cues} cues, {repeat} conversion(s) of each per method")
+        click.echo(f"{'method':>10} {'median ms':>10} {'p95 ms':>10} {'total s':>10}")
+        for method, samples in timings.items():
+            samples.sort()
+            p95 = samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+            click.echo(f"{method:>10} {statistics.median(samples):>10.2f} {p95:>10.2f} {sum(samples) / 1000:>10.2f}")
@@ -0,0 +1,120 @@
+from urllib.parse import quote
+from dotenv import load_dotenv
+import hashlib
+import click
+import json
+import os
+
+try:
+    from PIL import Image, features
+except ImportError:  # pillow is optional, the homepage falls back to the full size posters without it
+    Image = None
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+# widths to generate, the homepage grid shows posters 180px wide (28vw on phones), so 1x/2x/3x of that
+THUMBNAIL_WIDTHS = [int(w) for w in os.getenv("THUMBNAIL_WIDTHS", "180,360,540").split(",") if w]
+THUMBNAIL_QUALITY = int(os.getenv("THUMBNAIL_QUALITY", 80))
+THUMBNAIL_DIR = "thumbs"  # relative to the movie folder
+THUMBNAIL_SIZES = "(max-width: 600px) 28vw, 180px"  # matches the grid in global.css
+
+
+# file name of one thumbnail, content hashed so it can be cached forever
+def thumbnail_name(content_hash, width, fmt):
+    return f"poster-{content_hash}-{width}.{fmt}"
+
+
+def _formats():
+    return ["webp", "jpg"] if features.check("webp") else ["jpg"]
+
+
+# generates webp/jpeg thumbnails of a movie folder's poster.jpg at each configured width (never upscaling),
+# returns their manifest for metadata.json, None if there is no poster or pillow isn't installed,
+# does nothing if thumbnails of this exact poster already exist unless forced
+def generate_thumbnails(base_path, force=False):
+    poster_path = os.path.join(base_path, "poster.jpg")
+    if Image is None or not os.path.exists(poster_path):
+        return None
+
+    with open(poster_path, "rb") as f:
+        content_hash = hashlib.sha1(f.read()).hexdigest()[:12]
+    thumbs_dir = os.path.join(base_path, THUMBNAIL_DIR)
+
+    with Image.open(poster_path) as poster:
+        poster = poster.convert("RGB")
+        widths = sorted({min(w, poster.width) for w in THUMBNAIL_WIDTHS})
+        manifest = {"hash": content_hash, "widths": widths, "formats": _formats()}
+        wanted = {thumbnail_name(content_hash, w, fmt) for w in widths for fmt in manifest["formats"]}
+        existing = set(os.listdir(thumbs_dir)) if os.path.isdir(thumbs_dir) else set()
+        if not force and wanted <= existing:
+            return manifest
+
+        os.makedirs(thumbs_dir, exist_ok=True)
+        for width in widths:
+            thumb = poster.resize((width, round(poster.height * width / poster.width)), Image.LANCZOS)
+            for fmt in manifest["formats"]:
+                path = os.path.join(thumbs_dir, thumbnail_name(content_hash, width, fmt))
+                thumb.save(f"{path}.tmp", "WEBP" if fmt == "webp" else "JPEG",
+                           quality=THUMBNAIL_QUALITY, optimize=True, **({"method": 6} if fmt == "webp" else {}))
+                os.replace(f"{path}.tmp", path)
+
+    # thumbnails of an older poster are no longer referenced by anything
+    for name in existing - wanted:
+        os.remove(os.path.join(thumbs_dir, name))
+    return manifest
+
+
+# generates thumbnails for a folder that already has metadata.json and records them in it
+def backfill_folder(base_path, force=False):
+    metadata_path = os.path.join(base_path, "metadata.json")
+    manifest = generate_thumbnails(base_path, force)
+    if manifest is None or not os.path.exists(metadata_path):
+        return False
+
+    with open(metadata_path, encoding="utf-8") as f:
+        metadata = json.load(f)
+    if metadata.get("poster_thumbnails") == manifest:
+        return True
+    metadata["poster_thumbnails"] = manifest
+    tmp_path = f"{metadata_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(metadata, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, metadata_path)
+    return True
+
+
+# url of one thumbnail, the folder name percent-encoded since spaces would split a srcset candidate
+def thumbnail_url(name, manifest, width, fmt):
+    return f"/media/{quote(name)}/{THUMBNAIL_DIR}/{thumbnail_name(manifest['hash'], width, fmt)}"
+
+
+# srcset strings per format (webp, jpg) for a movie's poster thumbnails, {} if it has none
+def poster_srcsets(name, manifest):
+    if not manifest:
+        return {}
+    return {
+        fmt: ", ".join(f"{thumbnail_url(name, manifest, w, fmt)} {w}w" for w in manifest["widths"])
+        for fmt in manifest["formats"]
+    }
+
+
+def init_app(app):
+    # flask backfill-thumbnails [--force], generates thumbnails for every movie already in the library
+    @app.cli.command("backfill-thumbnails")
+    @click.option("--force", is_flag=True, help="Regenerate thumbnails that already exist.")
+    def backfill_thumbnails(force):
+        if Image is None:
+            raise click.ClickException("Pillow is not installed (pip install Pillow)")
+        from .library import library
+        media_path = app.config['MEDIA_PATH']
+        done = 0
+        for name in sorted(os.listdir(media_path)):
+            base_path = os.path.join(media_path, name)
+            if not os.path.isdir(base_path):
+                continue
+            try:
+                if backfill_folder(base_path, force):
+                    library.refresh(name)
+                    done += 1
+            except (OSError, ValueError) as e:
+                click.echo(f"Failed to generate thumbnails for {name}: {e}", err=True)
+        click.echo(f"Generated thumbnails for {done} movie(s)")
@@ -0,0 +1,143 @@
+from requests.adapters import HTTPAdapter
+from collections import OrderedDict
+from urllib.parse import urlencode
+from dotenv import load_dotenv
+import threading
+import requests
+import sqlite3
+import json
+import time
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+TMDB_API_KEY = os.getenv("TMDB_API_KEY")
+TMDB_API_URL = "https://api.themoviedb.org/3"
+TMDB_TIMEOUT = float(os.getenv("TMDB_TIMEOUT", 10))
+TMDB_SEARCH_TTL = int(os.getenv("TMDB_SEARCH_TTL", 60 * 60))          # seconds
+TMDB_MOVIE_TTL = int(os.getenv("TMDB_MOVIE_TTL", 7 * 24 * 60 * 60))    # seconds
+TMDB_CACHE_SIZE = int(os.getenv("TMDB_CACHE_SIZE", 2000))              # entries
+
+
+class TMDbError(Exception):
+    pass
+
+
+# one in-flight request that identical concurrent requests wait on instead of sending their own
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# TMDb API client with a pooled keep-alive session, an LRU+TTL response cache persisted to sqlite,
+# and single-flight coalescing of identical in-flight requests
+class TMDbClient:
+    def __init__(self, api_key, base_url=TMDB_API_URL, timeout=TMDB_TIMEOUT, max_entries=TMDB_CACHE_SIZE):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.max_entries = max_entries
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {api_key}"
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=4))
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=4))
+        self.lock = threading.Lock()
+        self.cache = OrderedDict()   # key -> (expires, response json), least recently used first
+        self.in_flight = {}          # key -> _Flight
+        self.cache_path = None
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+
+    def init_app(self, app):
+        self.cache_path = app.config['TMDB_CACHE_PATH']
+        self.logger = app.logger
+        try:
+            with self._connect() as db:
+                db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+                rows = db.execute("SELECT key, expires, value FROM cache ORDER BY expires").fetchall()
+        except sqlite3.Error as e:
+            app.logger.warning(f"Failed to load TMDb cache: {e}")
+            return
+        with self.lock:
+            for key, expires, value in rows[-self.max_entries:]:
+                self.cache[key] = (expires, json.loads(value))
+
+    def _connect(self):
+        db = sqlite3.connect(self.cache_path, timeout=30)
+        db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, expires REAL, value TEXT)")
+        return db
+
+    # stores a response in memory and on disk, evicting the least recently used entries
+    def _store(self, key, expires, value):
+        with self.lock:
+            self.cache[key] = (expires, value)
+            self.cache.move_to_end(key)
+            evicted = []
+            while len(self.cache) > self.max_entries:
+                evicted.append(self.cache.popitem(last=False)[0])
+        if self.cache_path is None:
+            return
+        try:
+            with self._connect() as db:
+                db.execute("INSERT OR REPLACE INTO cache (key, expires, value) VALUES (?, ?, ?)", (key, expires, json.dumps(value)))
+                db.executemany("DELETE FROM cache WHERE key = ?", [(k,) for k in evicted])
+        except sqlite3.Error as e:
+            self.logger.warning(f"Failed to persist TMDb cache entry: {e}")
+
+    def _get(self, path, params, ttl):
+        key = f"{path}?{urlencode(sorted(params.items()))}"
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry and entry[0] > time.time():
+                self.cache.move_to_end(key)
+                self.counters["hits"] += 1
+                return entry[1]
+            flight = self.in_flight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.in_flight[key] = _Flight()
+                self.counters["misses"] += 1
+            else:
+                self.counters["coalesced"] += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+
+        try:
+            r = self.session.get(f"{self.base_url}{path}", params=params, timeout=self.timeout)
+            if r.status_code != 200:
+                raise TMDbError(f"TMDb {path} failed: {r.status_code} {r.text}")
+            flight.result = r.json()
+            self._store(key, time.time() + ttl, flight.result)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            with self.lock:
+                self.counters["errors"] += 1
+            raise
+        finally:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            flight.done.set()
+
+    # movie search results for given query
+    def search_movie(self, query):
+        params = {"query": query, "include_adult": False, "language": "en-US", "page": 1}
+        return self._get("/search/movie", params, TMDB_SEARCH_TTL).get("results", [])
+
+    # movie details for given tmdb id
+    def movie(self, tmdb_id):
+        return self._get(f"/movie/{tmdb_id}", {}, TMDB_MOVIE_TTL)
+
+    def stats(self):
+        with self.lock:
+            c = dict(self.counters)
+            c["size"] = len(self.cache)
+        lookups = c["hits"] + c["misses"] + c["coalesced"]
+        c["hit_rate"] = round((c["hits"] + c["coalesced"]) / lookups, 3) if lookups else 0.0
+        return c
+
+
+tmdb = TMDbClient(TMDB_API_KEY)
@@ -0,0 +1,89 @@
+from .qbittorrent import qbittorrent
+from .utils import normalize
+from dotenv import load_dotenv
+import threading
+import time
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+QBITTORRENT_POLL_INTERVAL = float(os.getenv("QBITTORRENT_POLL_INTERVAL", 1.5))  # seconds between syncs
+
+
+# background thread mirroring qBittorrent's torrent list through the incremental /sync/maindata
+# endpoint, so routes can answer download progress without any outbound HTTP
+class TorrentPoller:
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.ready = threading.Event()
+        self.rid = 0
+        self.version = 0     # bumped whenever any torrent changes
+        self.torrents = {}   # hash -> torrent
+        self.by_title = {}   # normalized save folder name -> hash
+
+    def init_app(self, app):
+        self.logger = app.logger
+        if not self.client.host:
+            app.logger.warning("QBITTORRENT_HOST not set, torrent poller disabled")
+            self.ready.set()  # nothing to wait for, there are no torrents
+            return
+        if app.config['BACKGROUND_WORKERS']:
+            threading.Thread(target=self._poll_loop, name="torrent-poller", daemon=True).start()
+
+    def _poll_loop(self):
+        while True:
+            try:
+                self.sync()
+            except Exception as e:
+                self.logger.warning(f"Failed to sync torrents: {e}")
+                self.rid = 0  # start over with a full update
+            time.sleep(QBITTORRENT_POLL_INTERVAL)
+
+    # applies one incremental update from qBittorrent to the torrent table
+    def sync(self):
+        data = self.client.sync_maindata(self.rid)
+        with self.lock:
+            if data.get("full_update"):
+                self.torrents = {}
+            for hash_, fields in data.get("torrents", {}).items():
+                self.torrents.setdefault(hash_, {"hash": hash_}).update(fields)
+            for hash_ in data.get("torrents_removed", []):
+                self.torrents.pop(hash_, None)
+            self.by_title = {
+                normalize(os.path.basename(t.get("save_path", "").rstrip("/\\"))): hash_
+                for hash_, t in self.torrents.items()
+            }
+            self.rid = data.get("rid", 0)
+            if data.get("full_update") or data.get("torrents") or data.get("torrents_removed"):
+                self.version += 1
+                self.changed.notify_all()
+        self.ready.set()
+
+    # blocks until the torrent table changes from given version, or timeout, returning the current version
+    def wait_for_change(self, version, timeout):
+        with self.changed:
+            self.changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    # whether the torrent table reflects qBittorrent yet, so a missing torrent really is missing
+    def synced(self):
+        return self.ready.is_set()
+
+    # copies of the torrents in given category that haven't finished downloading
+    def unfinished(self, category):
+        with self.lock:
+            return [dict(t) for t in self.torrents.values() if t.get("category") == category and t.get("progress", 0) < 1.0]
+
+    # returns copy of torrent downloading given movie title, matching its save folder first then its name
+    def find(self, title, timeout=2):
+        self.ready.wait(timeout)
+        key = normalize(title)
+        with self.lock:
+            hash_ = self.by_title.get(key)
+            if hash_ is None:
+                hash_ = next((h for h, t in self.torrents.items() if key in normalize(t.get("name", ""))), None)
+            return dict(self.torrents[hash_]) if hash_ else None
+
+
+torrent_poller = TorrentPoller(qbittorrent)
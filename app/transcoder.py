@@ -0,0 +1,262 @@
+from .packaging import BROWSER_VIDEO_CODECS, BROWSER_AUDIO_CODECS
+from .probe import probe
+from .state import state
+from contextlib import contextmanager
+from dotenv import load_dotenv
+import subprocess
+import threading
+import shutil
+import math
+import time
+import os
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+TRANSCODE_SEGMENT_SECONDS = int(os.getenv("TRANSCODE_SEGMENT_SECONDS", 6))
+TRANSCODE_WORKERS = int(os.getenv("TRANSCODE_WORKERS", max(1, min(2, (os.cpu_count() or 1) // 2))))
+TRANSCODE_PREFETCH = int(os.getenv("TRANSCODE_PREFETCH", 3))                       # segments ahead of the playhead
+TRANSCODE_CACHE_BYTES = int(os.getenv("TRANSCODE_CACHE_MB", 4096)) * 1024 * 1024   # on-disk segment cache budget
+TRANSCODE_WAIT = 120  # seconds a request waits for its segment, also the most one transcode holds a slot for
+SLOT_POLL_INTERVAL = 0.2  # seconds between attempts at a transcode slot when every one is taken
+BROWSER_CONTAINERS = (".mp4", ".m4v", ".mov")
+
+
+# whether a movie file needs transcoding before a browser can play it, from its probe summary
+# (the one recorded in metadata.json if given, else the cached probe)
+def needs_transcode(path, media=None):
+    media = media if media and "video" in media else probe(path)
+    video = media["video"] or {}
+    audio = media["audio"][0] if media["audio"] else None
+    return not (path.lower().endswith(BROWSER_CONTAINERS)
+                and video.get("codec") in BROWSER_VIDEO_CODECS
+                and (audio is None or audio["codec"] in BROWSER_AUDIO_CODECS))
+
+
+# version of a source file its cached segments belong to, a re-downloaded movie of the same name is a new inode
+def source_version(source):
+    st = os.stat(source)
+    return f"{st.st_ino:x}-{st.st_mtime_ns:x}"
+
+
+# one segment to transcode, and everyone waiting on it
+class _Segment:
+    def __init__(self, movie, version, source, index):
+        self.movie = movie
+        self.version = version
+        self.source = source
+        self.index = index
+        self.waiters = 0
+        self.done = threading.Event()
+        self.path = None
+        self.error = None
+
+
+# on-demand transcoder: segments are transcoded by ffmpeg workers, at most TRANSCODE_WORKERS at a time across every
+# gunicorn worker (slots are locks in the shared state store), nearest-to-playhead first, and kept in an on-disk LRU
+# cache within a size budget, under the source file's version so a replaced file never serves stale segments
+class Transcoder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.queue = {}      # (movie, version, index) -> _Segment waiting for a worker
+        self.running = {}    # (movie, version, index) -> _Segment being transcoded
+        self.playheads = {}  # movie -> segment index last requested by a viewer
+        self.versions = {}   # movie -> source version last requested, older versions' segments get dropped
+        self.durations = {}  # (source, mtime) -> seconds
+        self.cache_bytes = 0
+
+    def init_app(self, app):
+        self.cache_path = app.config['TRANSCODE_CACHE_PATH']
+        self.logger = app.logger
+        os.makedirs(self.cache_path, exist_ok=True)
+        self.cache_bytes = sum(size for _, size, _ in self._cached_files())
+        if not app.config['BACKGROUND_WORKERS']:
+            return
+        for i in range(TRANSCODE_WORKERS):
+            threading.Thread(target=self._work_loop, name=f"transcoder-{i}", daemon=True).start()
+
+    def duration(self, source):
+        key = (source, os.path.getmtime(source))
+        if key not in self.durations:
+            self.durations[key] = probe(source)["duration"]
+        return self.durations[key]
+
+    # vod playlist of fixed-length segments covering the whole movie
+    def playlist(self, source):
+        duration = self.duration(source)
+        count = math.ceil(duration / TRANSCODE_SEGMENT_SECONDS)
+        lines = ["#EXTM3U", "#EXT-X-VERSION:3", f"#EXT-X-TARGETDURATION:{TRANSCODE_SEGMENT_SECONDS}",
+                 "#EXT-X-PLAYLIST-TYPE:VOD", "#EXT-X-MEDIA-SEQUENCE:0"]
+        for i in range(count):
+            length = min(TRANSCODE_SEGMENT_SECONDS, duration - i * TRANSCODE_SEGMENT_SECONDS)
+            lines += [f"#EXTINF:{length:.3f},", f"seg_{i}.ts"]
+        lines.append("#EXT-X-ENDLIST")
+        return "\n".join(lines) + "\n"
+
+    def _segment_path(self, movie, version, index):
+        return os.path.join(self.cache_path, movie, version, f"seg_{index}.ts")
+
+    # returns path of a transcoded segment, transcoding it (and queueing the next few) if it isn't cached
+    def segment(self, movie, source, index):
+        count = math.ceil(self.duration(source) / TRANSCODE_SEGMENT_SECONDS)
+        if not 0 <= index < count:
+            return None
+        version = source_version(source)
+        if self.versions.get(movie) != version:
+            self._drop_versions(movie, keep=version)
+
+        with self.lock:
+            self.versions[movie] = version
+            self.playheads[movie] = index
+            window = range(index, min(index + 1 + TRANSCODE_PREFETCH, count))
+            # a seek leaves the queued segments around the old playhead behind, unless someone is waiting on one
+            for key in [key for key, seg in self.queue.items()
+                        if key[0] == movie and not seg.waiters and (key[1] != version or key[2] not in window)]:
+                del self.queue[key]
+            wanted = None
+            for i in window:
+                seg = self._request(movie, version, source, i)
+                if i == index:
+                    wanted = seg
+            if wanted:
+                wanted.waiters += 1
+            self.wakeup.notify_all()
+
+        if wanted is None:  # already cached
+            path = self._segment_path(movie, version, index)
+            os.utime(path)  # mark as recently used
+            return path
+        try:
+            if not wanted.done.wait(TRANSCODE_WAIT):
+                raise TimeoutError(f"Timed out transcoding {movie} segment {index}")
+        finally:
+            with self.lock:
+                wanted.waiters -= 1
+        if wanted.error:
+            raise wanted.error
+        return wanted.path
+
+    # queues a segment unless it's cached, returning the pending _Segment or None, lock must be held
+    def _request(self, movie, version, source, index):
+        key = (movie, version, index)
+        seg = self.queue.get(key) or self.running.get(key)
+        if seg:
+            return seg
+        if os.path.exists(self._segment_path(movie, version, index)):
+            return None
+        seg = self.queue[key] = _Segment(movie, version, source, index)
+        return seg
+
+    # deletes a movie's cached segments, all of them or every version but keep
+    def _drop_versions(self, movie, keep=None):
+        movie_dir = os.path.join(self.cache_path, movie)
+        try:
+            stale = [entry.path for entry in os.scandir(movie_dir) if entry.name != keep]
+        except OSError:
+            return
+        for path in stale:
+            shutil.rmtree(path, ignore_errors=True)
+        if stale:
+            total = sum(size for _, size, _ in self._cached_files())
+            with self.lock:
+                self.cache_bytes = total
+
+    # forgets a deleted movie: its queued segments and everything it has in the cache
+    def forget(self, movie):
+        with self.lock:
+            for key in [key for key in self.queue if key[0] == movie]:
+                del self.queue[key]
+            self.playheads.pop(movie, None)
+            self.versions.pop(movie, None)
+        self._drop_versions(movie)
+        shutil.rmtree(os.path.join(self.cache_path, movie), ignore_errors=True)
+
+    # next segment to transcode: the one closest to (and preferably after) its movie's playhead
+    def _next(self):
+        def priority(key):
+            movie, _, index = key
+            distance = index - self.playheads.get(movie, 0)
+            return distance if distance >= 0 else TRANSCODE_PREFETCH - distance
+        key = min(self.queue, key=priority)
+        seg = self.running[key] = self.queue.pop(key)
+        return seg
+
+    # holds one of the TRANSCODE_WORKERS transcode slots shared by every gunicorn worker (and hls packaging),
+    # waiting for a free one, for at most ttl seconds
+    @contextmanager
+    def slot(self, ttl=TRANSCODE_WAIT):
+        while True:
+            for i in range(TRANSCODE_WORKERS):
+                with state.lock(f"transcode-slot-{i}", ttl=ttl, blocking=False) as acquired:
+                    if acquired:
+                        yield
+                        return
+            time.sleep(SLOT_POLL_INTERVAL)
+
+    def _work_loop(self):
+        while True:
+            with self.wakeup:
+                self.wakeup.wait_for(lambda: self.queue)
+            with self.slot():
+                with self.lock:
+                    if not self.queue:  # taken by another thread, or pruned by a seek, while waiting for the slot
+                        continue
+                    seg = self._next()  # picked once the slot is held, so it's the most urgent one by then
+                try:
+                    seg.path = self._transcode(seg)
+                except Exception as e:
+                    self.logger.error(f"Failed to transcode {seg.movie} segment {seg.index}: {e}")
+                    seg.error = e
+                with self.lock:
+                    self.running.pop((seg.movie, seg.version, seg.index), None)
+                seg.done.set()
+
+    def _transcode(self, seg):
+        start = seg.index * TRANSCODE_SEGMENT_SECONDS
+        path = self._segment_path(seg.movie, seg.version, seg.index)
+        if os.path.exists(path):  # another gunicorn worker got to it first
+            return path
+        tmp_path = f"{path}.{os.getpid()}.tmp"  # per process, workers can race on the same segment
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        subprocess.run([
+            "ffmpeg", "-y", "-v", "error", "-ss", str(start), "-i", seg.source, "-t", str(TRANSCODE_SEGMENT_SECONDS),
+            "-map", "0:v:0", "-map", "0:a:0?", "-c:v", "libx264", "-preset", "veryfast", "-crf", "23",
+            "-c:a", "aac", "-b:a", "128k", "-ac", "2", "-output_ts_offset", str(start), "-f", "mpegts", tmp_path
+        ], check=True)
+        os.replace(tmp_path, path)
+
+        size = os.path.getsize(path)
+        with self.lock:
+            self.cache_bytes += size
+            over_budget = self.cache_bytes > TRANSCODE_CACHE_BYTES
+        if over_budget:
+            self._evict()
+        return path
+
+    # (path, size, last used) of every cached segment
+    def _cached_files(self):
+        files = []
+        for root, _, names in os.walk(self.cache_path):
+            for name in names:
+                if name.endswith(".ts"):
+                    st = os.stat(os.path.join(root, name))
+                    files.append((os.path.join(root, name), st.st_size, st.st_mtime))
+        return files
+
+    # deletes least recently used segments until the cache is back within budget
+    def _evict(self):
+        files = sorted(self._cached_files(), key=lambda f: f[2])
+        total = sum(size for _, size, _ in files)
+        recent = time.time() - TRANSCODE_WAIT  # never evict segments that are probably still being streamed
+        for path, size, used in files:
+            if total <= TRANSCODE_CACHE_BYTES * 0.9 or used > recent:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+        with self.lock:
+            self.cache_bytes = total
+
+
+transcoder = Transcoder()
@@ -1,15 +1,14 @@
 from dotenv import load_dotenv
 from flask import current_app
-import subprocess
+from .library import library
+from .disk_usage import disk_usage
+from .tmdb import tmdb, TMDbError
 import requests
-import shutil
 import json
 import os
 import re
 
-OPENSUBTITLES_API_KEY = os.getenv("OPENSUBTITLES_API_KEY")
 load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
-TMDB_API_KEY = os.getenv("TMDB_API_KEY")
 
 # normalises string to remove any special characters
 def normalize(title):
@@ -22,142 +21,21 @@ def load_progress(path):
             return json.load(f)
     return {}
 
-# updates json file with given data
-def save_progress(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f)
 
 
-
-# converts srt subtitles to vtt format (ideal for web use)
-def convert_srt_to_vtt(srt_path):
-    vtt_path = srt_path.replace(".srt", ".vtt")
+# fetches movie details from tmdb given the movie id (cached), None on failure
+def fetch_tmdb_movie(tmdb_id):
     try:
-        subprocess.run(["ffmpeg", "-y", "-i", srt_path, vtt_path], check=True)
-        os.remove(srt_path)
-        print(f"Converted {srt_path} to {vtt_path}")
-        return vtt_path
-    except subprocess.CalledProcessError as e:
-        print(f"Failed to convert subtitle: {e}")
+        return tmdb.movie(tmdb_id)
+    except (TMDbError, requests.RequestException) as e:
+        current_app.logger.error(f"Failed to fetch TMDb data: {e}")
         return None
 
 
 
-# searches for subs using opensubtitles, downloads most popular subs to given save path
-def search_and_download_subtitle(movie_name, save_path, language="en"):
-    search_url = "https://api.opensubtitles.com/api/v1/subtitles"
-    headers = {
-        "Api-Key": OPENSUBTITLES_API_KEY,
-        "User-Agent": "home server"
-    }
-
-    params = {
-        "query": movie_name,
-        "languages": language,
-        "order_by": "download_count",
-        "order_direction": "desc"
-    }
-
-    # sends request to search for subs
-    response = requests.get(search_url, headers=headers, params=params)
-    try:
-        data = response.json()
-    except Exception:
-        print("Failed to decode JSON.")
-        print("Status Code:", response.status_code)
-        print("Response text:", response.text)
-        return False
-
-    if "data" not in data or not data["data"]:
-        print(f"No subtitles found for movie: {movie_name}")
-        return False
-
-    best_match = data["data"][0]
-    file_id = best_match["attributes"]["files"][0]["file_id"]
-
-    # sends request to download subs
-    download_url = "https://api.opensubtitles.com/api/v1/download"
-    r = requests.post(download_url, headers=headers, json={"file_id": file_id})
-    try:
-        dl_link = r.json().get("link")
-    except Exception:
-        print("Failed to parse download response JSON.")
-        print("Status Code:", r.status_code)
-        print("Response text:", r.text)
-        return False
-
-    if not dl_link:
-        print("No download link found")
-        return False
-
-    # Downloads subtitle file
-    sub_response = requests.get(dl_link)
-    os.makedirs(save_path, exist_ok=True)
-    srt_path = os.path.join(save_path, "subtitles.srt")
-    with open(srt_path, "wb") as f:
-        f.write(sub_response.content)
-
-    print(f"Subtitle saved to: {srt_path}")
-
-    # Converts to .vtt
-    vtt_path = convert_srt_to_vtt(srt_path)
-    return vtt_path is not None
-
-
-
-# move biggest file from child to parent folder, renames file to 'movie.{ext}', removes child folder
-def finalize_movie_folder(base_path):
-    contents = os.listdir(base_path)
-    dirs = [d for d in contents if os.path.isdir(os.path.join(base_path, d))]
-
-    if len(dirs) != 1:
-        current_app.logger.warning(f"Unexpected folder structure in {base_path}: {dirs}")
-        return False
-
-    inner_folder = os.path.join(base_path, dirs[0])
-    video_files = []
-
-    # finds biggest video file in child folder
-    for root, _, files in os.walk(inner_folder):
-        for file in files:
-            if file.lower().endswith((".mp4", ".mkv", ".avi", ".mov")):
-                full_path = os.path.join(root, file)
-                size = os.path.getsize(full_path)
-                video_files.append((size, full_path, file))
-
-    if not video_files:
-        current_app.logger.warning(f"No video files found in {inner_folder}")
-        return False
-
-    # Pick the largest video file
-    _, src_path, original_filename = max(video_files, key=lambda x: x[0])
-    ext = os.path.splitext(original_filename)[1]
-    dst_path = os.path.join(base_path, f"movie{ext}")
-
-    # move video file from child, then remove child
-    shutil.move(src_path, dst_path)
-    shutil.rmtree(inner_folder)
-    current_app.logger.info(f"Moved {original_filename} to {dst_path} and removed {inner_folder}")
-    return True
-
-
-
-# downloads poster from tmdb database, given the movie id, and saves to given path
-def download_poster_and_metadata(tmdb_id, save_path):
-    
-    # sends request to tmdb of given movie id
-    headers = {"Authorization": f"Bearer {TMDB_API_KEY}"}
-    url = f"https://api.themoviedb.org/3/movie/{tmdb_id}"
-    r = requests.get(url, headers=headers)
-    
-    if r.status_code != 200:
-        current_app.logger.error(f"Failed to fetch TMDb data: {r.text}")
-        return False
-
-    data = r.json()
-    poster_path = data.get("poster_path")
-
-    # saves metadata of movie
+# saves metadata of movie from its tmdb details (and its poster thumbnails and movie file's probe) into the movie path,
+# making it show up in the library
+def write_metadata(tmdb_id, data, save_path, thumbnails=None, media=None):
     metadata = {
         "title": data.get("title"),
         "overview": data.get("overview"),
@@ -165,11 +43,14 @@ def download_poster_and_metadata(tmdb_id, save_path):
         "genres": [genre["name"] for genre in data.get("genres", [])],
         "runtime": data.get("runtime"),
         "rating": data.get("vote_average"),
-        "poster_path": poster_path,
+        "poster_path": data.get("poster_path"),
         "tmdb_id": tmdb_id
     }
+    if thumbnails:
+        metadata["poster_thumbnails"] = thumbnails
+    if media:
+        metadata["media"] = media
 
-    # places metadata and poster in the correct movie path
     metadata_file_path = os.path.join(save_path, "metadata.json")
     try:
         with open(metadata_file_path, "w", encoding="utf-8") as f:
@@ -177,14 +58,17 @@ def download_poster_and_metadata(tmdb_id, save_path):
     except Exception as e:
         current_app.logger.error(f"Failed to write metadata.json: {e}")
         return False
+    library.refresh(os.path.basename(save_path))
+    disk_usage.invalidate(os.path.basename(save_path))
+    return True
 
-    if not poster_path:
-        current_app.logger.warning(f"No poster path for TMDb ID {tmdb_id}")
-        return False
 
+
+# downloads poster from tmdb given its poster path, and saves to given path
+def download_poster(poster_path, save_path, timeout=None):
     full_poster_url = f"https://image.tmdb.org/t/p/original{poster_path}"
-    poster_response = requests.get(full_poster_url, stream=True)
-    
+    poster_response = requests.get(full_poster_url, stream=True, timeout=timeout)
+
     if poster_response.status_code == 200:
         poster_file = os.path.join(save_path, "poster.jpg")
         with open(poster_file, "wb") as f:
@@ -0,0 +1,278 @@
+from .library import library
+from .disk_usage import disk_usage
+from .downloads import downloads
+from .torrent_poller import torrent_poller
+from .postprocess import enqueue_post_process, post_process_key
+from .jobs import job_queue
+from .tmdb import tmdb, TMDbError
+from .finalize import VIDEO_EXTENSIONS
+from .probe import forget as forget_probes
+from .transcoder import transcoder
+from .releases import YEAR
+from .utils import normalize
+from dotenv import load_dotenv
+import ctypes.util
+import threading
+import requests
+import ctypes
+import select
+import struct
+import errno
+import time
+import os
+import re
+
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+WATCHER_DEBOUNCE = float(os.getenv("WATCHER_DEBOUNCE", 5))                       # seconds a folder has to be quiet
+WATCHER_RECONCILE_INTERVAL = float(os.getenv("WATCHER_RECONCILE_INTERVAL", 300))  # seconds between full scans
+
+# inotify(7) constants, IN_MODIFY is left out on purpose so a torrent writing pieces doesn't wake us up
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR
+EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+PARTIAL_SUFFIXES = (".!qb", ".part", ".parts", ".crdownload")  # files a torrent client hasn't finished
+
+
+# thin ctypes wrapper over linux inotify, raises OSError where it isn't available
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError(errno.ENOSYS, "inotify not available")
+        self.libc = libc
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    # starts watching a directory, returns its watch descriptor
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), ctypes.c_uint32(mask))
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+        return wd
+
+    # waits up to timeout seconds for events, returns [(wd, mask, name)]
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], max(timeout, 0))[0]:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events, offset = [], 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+
+# watches the media library so changes made outside the app reach the library index and disk usage, and completed
+# downloads get post-processed even when nobody has the page open: events are debounced per movie folder, and a
+# periodic reconciliation scan catches anything inotify missed (queue overflow, watch limits, no inotify at all)
+class LibraryWatcher:
+    def __init__(self):
+        self.inotify = None
+        self.watches = {}   # wd -> path relative to the media library, "" for the library itself
+        self.pending = {}   # movie folder name -> time it's been quiet long enough
+        self.last_reconcile = 0
+
+    def init_app(self, app):
+        self.app = app
+        self.media_path = app.config['MEDIA_PATH']
+        self.logger = app.logger
+        if not app.config['BACKGROUND_WORKERS']:
+            return
+        try:
+            self.inotify = Inotify()
+            self._watch_tree("")
+        except OSError as e:
+            self.inotify = None
+            app.logger.warning(f"inotify unavailable ({e}), only scanning the library every {WATCHER_RECONCILE_INTERVAL}s")
+        threading.Thread(target=self._watch_loop, name="library-watcher", daemon=True).start()
+
+    # watches a directory of the library and every directory under it
+    def _watch_tree(self, rel):
+        watched = set(self.watches.values())
+        for root, dirs, _ in os.walk(os.path.join(self.media_path, rel)):
+            rel_root = os.path.relpath(root, self.media_path)
+            rel_root = "" if rel_root == "." else rel_root
+            if rel_root in watched:
+                continue
+            try:
+                self.watches[self.inotify.add_watch(root, WATCH_MASK)] = rel_root
+            except OSError as e:
+                if e.errno == errno.ENOSPC:  # out of watches, the reconciliation scan still covers it
+                    self.logger.warning(f"Out of inotify watches at {root}, raise fs.inotify.max_user_watches")
+                    return
+                dirs[:] = []  # removed meanwhile
+
+    def _watch_loop(self):
+        while True:
+            now = time.monotonic()
+            next_reconcile = self.last_reconcile + WATCHER_RECONCILE_INTERVAL
+            timeout = min([next_reconcile] + list(self.pending.values())) - now
+            try:
+                if self.inotify:
+                    self._handle(self.inotify.read(timeout))
+                else:
+                    time.sleep(max(timeout, 0))
+
+                now = time.monotonic()
+                for name in [name for name, due in self.pending.items() if due <= now]:
+                    del self.pending[name]
+                    self._sync(name)
+                if now >= next_reconcile:
+                    self.reconcile()
+            except Exception as e:
+                self.logger.warning(f"Library watcher failed: {e}")
+                time.sleep(WATCHER_DEBOUNCE)
+
+    # notes which movie folders changed, (re)watching new directories
+    def _handle(self, events):
+        for wd, mask, name in events:
+            if mask & IN_Q_OVERFLOW:
+                self.logger.warning("inotify queue overflowed, reconciling the library")
+                self.last_reconcile = 0
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            rel = self.watches.get(wd)
+            if rel is None:
+                continue
+            path = os.path.join(rel, name) if name else rel
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path)
+            folder = path.split(os.sep, 1)[0]
+            if folder:
+                self.pending[folder] = time.monotonic() + WATCHER_DEBOUNCE
+
+    # brings the index up to date with one movie folder, and ingests it if it's a finished download
+    def _sync(self, name):
+        if not os.path.isdir(os.path.join(self.media_path, name)):
+            library.remove(name)
+            disk_usage.invalidate(name)
+            forget_probes(os.path.join(self.media_path, name))
+            transcoder.forget(name)
+            return
+        library.refresh(name)
+        disk_usage.invalidate(name)
+        if not os.path.exists(os.path.join(self.media_path, name, "metadata.json")):
+            with self.app.app_context():
+                self.ingest(name)
+
+    # full scan: re-indexes the library, ingests finished downloads and picks up directories that lack a watch
+    def reconcile(self):
+        self.last_reconcile = time.monotonic()
+        library.revalidate(force=True)
+        if self.inotify:
+            self._watch_tree("")
+        try:
+            names = [entry.name for entry in os.scandir(self.media_path) if entry.is_dir()]
+        except OSError as e:
+            self.logger.warning(f"Failed to scan media library: {e}")
+            return
+        with self.app.app_context():
+            for name in names:
+                if not os.path.exists(os.path.join(self.media_path, name, "metadata.json")):
+                    self.ingest(name)
+
+    # queues post-processing of a movie folder without metadata once its payload is complete,
+    # for a requested movie through its download request, otherwise by looking its name up on tmdb
+    def ingest(self, name):
+        base_path = os.path.join(self.media_path, name)
+        has_video, partial, newest = _scan_payload(base_path)
+        if not has_video or partial:
+            return
+        if time.time() - newest < WATCHER_DEBOUNCE:
+            self.pending[name] = time.monotonic() + WATCHER_DEBOUNCE  # still being written (copied in?), check back
+            return
+        if not torrent_poller.synced():
+            return  # a torrent still writing here wouldn't be known yet, the next scan comes back to it
+        torrent = torrent_poller.find(name, timeout=0)
+        if torrent and torrent["progress"] < 1.0:
+            return
+
+        d = downloads.for_title(name)
+        if d:
+            # the download monitor does the same from the torrent table, whichever is first moves it
+            if d["state"] == "downloading" and torrent and downloads.transition(
+                    d["tmdb_id"], "post-processing", ("downloading",), progress=1.0, torrent_state=torrent["state"]):
+                enqueue_post_process(d["tmdb_id"], name, base_path)
+            return
+
+        # not a requested movie: only folders no torrent could still be writing into, the name of one that is
+        # may not match the folder (and qBittorrent doesn't mark unfinished files by default)
+        if torrent is None and torrent_poller.unfinished("media"):
+            return
+        title, year = _parse_folder_name(name)
+        try:
+            results = tmdb.search_movie(title)
+        except (TMDbError, requests.RequestException) as e:
+            self.logger.warning(f"Failed to look up {name} on TMDb: {e}")
+            return
+        match = _match_result(results, title, year)
+        if match is None:
+            self.logger.info(f"No TMDb match for {name} (title {title!r}, year {year}), not ingesting it")
+            return
+        tmdb_id = match["id"]
+        job = job_queue.status(post_process_key(tmdb_id))
+        if job and job["status"] == "failed":
+            return  # gave up after its retries, re-requesting the movie starts over
+        if enqueue_post_process(tmdb_id, name, base_path):
+            self.logger.info(f"Ingesting {name} as TMDb ID {tmdb_id}")
+
+
+# (title, year) a movie folder's name suggests, e.g. "The.Matrix.1999.1080p" -> ("The Matrix", 1999),
+# year is None if the name has none
+def _parse_folder_name(name):
+    years = [m for m in YEAR.finditer(name) if m.start() > 0]  # a leading year is part of the title ("1917")
+    title = name[:years[-1].start()] if years else name
+    title = re.sub(r"[\s._()\[\]-]+", " ", title).strip() or name
+    return title, int(years[-1].group(1)) if years else None
+
+
+# the tmdb search result a folder is, the closest release year within a year of the folder's,
+# without a year only an exact title match, None if nothing fits
+def _match_result(results, title, year):
+    if year is None:
+        return next((r for r in results if normalize(r.get("title") or "") == normalize(title)), None)
+    dated = [(abs(int(r["release_date"][:4]) - year), i, r) for i, r in enumerate(results)
+             if (r.get("release_date") or "")[:4].isdigit()]
+    dated = [entry for entry in dated if entry[0] <= 1]
+    return min(dated, key=lambda entry: entry[:2])[2] if dated else None
+
+
+# looks through a download's folder, returns (whether it has a video, whether it has unfinished files,
+# mtime of its most recently written file)
+def _scan_payload(base_path):
+    has_video, partial, newest = False, False, 0
+    for root, _, files in os.walk(base_path):
+        for file in files:
+            lowered = file.lower()
+            partial = partial or lowered.endswith(PARTIAL_SUFFIXES)
+            has_video = has_video or lowered.endswith(VIDEO_EXTENSIONS)
+            try:
+                newest = max(newest, os.stat(os.path.join(root, file)).st_mtime)
+            except OSError:
+                continue
+    return has_video, partial, newest
+
+
+library_watcher = LibraryWatcher()
@@ -0,0 +1,13 @@
+from dotenv import load_dotenv
+import os
+
+# gunicorn settings, read automatically when it's started from the repo root: gunicorn "app:create_app()"
+load_dotenv(dotenv_path="/home/manavpi/home_server/.env")
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("GUNICORN_WORKERS", 2))
+
+# threaded workers: every open tab keeps an /events stream going for minutes, which on the default sync worker
+# holds a whole worker until the timeout kills it, here it holds one thread and the worker keeps heartbeating
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 16))
+timeout = 30
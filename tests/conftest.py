@@ -0,0 +1,50 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import threading
+import json
+import pytest
+
+
+# request handler for the fake api servers, tests set routes to {(method, path): fn(handler) -> (status, body)}
+class FakeHandler(BaseHTTPRequestHandler):
+    routes = {}
+
+    def _handle(self, method):
+        url = urlsplit(self.path)
+        self.query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        self.form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        self.cookies = dict(c.strip().split("=", 1) for c in self.headers.get("Cookie", "").split(";") if "=" in c)
+        self.set_cookie = None
+        route = self.routes.get((method, url.path))
+        status, body = route(self) if route else (404, "not found")
+        data = body.encode() if isinstance(body, str) else json.dumps(body).encode()
+        self.send_response(status)
+        if self.set_cookie:
+            self.send_header("Set-Cookie", self.set_cookie)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        self._handle("GET")
+
+    def do_POST(self):
+        self._handle("POST")
+
+    def log_message(self, *args):
+        pass
+
+
+# a local http server answering from routes, returns (base url, routes dict to fill in)
+@pytest.fixture
+def fake_server():
+    routes = {}
+    handler = type("Handler", (FakeHandler,), {"routes": routes})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}", routes
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,117 @@
+from app.qbittorrent import QBittorrentClient, QBittorrentError
+from app.torrent_poller import TorrentPoller
+import itertools
+import pytest
+
+
+# fake qBittorrent Web API: logins hand out a new SID, everything else answers 403 without a current one
+@pytest.fixture
+def qbt(fake_server):
+    url, routes = fake_server
+    server = {"logins": 0, "sids": set(), "maindata": {}, "rids": []}
+    counter = itertools.count(1)
+
+    def login(h):
+        if h.form.get("username") != "admin" or h.form.get("password") != "secret":
+            return 200, "Fails."
+        sid = f"sid{next(counter)}"
+        server["logins"] += 1
+        server["sids"].add(sid)
+        h.set_cookie = f"SID={sid}; path=/"
+        return 200, "Ok."
+
+    def authed(fn):
+        def route(h):
+            if h.cookies.get("SID") not in server["sids"]:
+                return 403, "Forbidden"
+            return fn(h)
+        return route
+
+    def maindata(h):
+        rid = int(h.query["rid"])
+        server["rids"].append(rid)
+        return 200, server["maindata"].get(rid, {"rid": rid})
+
+    routes[("POST", "/api/v2/auth/login")] = login
+    routes[("GET", "/api/v2/torrents/info")] = authed(lambda h: (200, [{"hash": "a", "name": "Heat"}]))
+    routes[("GET", "/api/v2/sync/maindata")] = authed(maindata)
+    return url, server
+
+
+def test_logs_in_once_and_reuses_the_sid(qbt):
+    url, server = qbt
+    client = QBittorrentClient(url, "admin", "secret")
+    assert client.torrents_info() == [{"hash": "a", "name": "Heat"}]
+    assert client.torrents_info() == [{"hash": "a", "name": "Heat"}]
+    assert server["logins"] == 1
+
+
+def test_logs_in_again_when_the_sid_expires(qbt):
+    url, server = qbt
+    client = QBittorrentClient(url, "admin", "secret")
+    client.torrents_info()
+    server["sids"].clear()  # qBittorrent restarted
+    assert client.torrents_info() == [{"hash": "a", "name": "Heat"}]
+    assert server["logins"] == 2
+
+
+def test_gives_up_after_one_login_retry(qbt, monkeypatch):
+    url, server = qbt
+    client = QBittorrentClient(url, "admin", "secret")
+    client.torrents_info()
+    login = client.login
+
+    def login_without_session():
+        login()
+        server["sids"].clear()  # a 403 even straight after logging in again
+    monkeypatch.setattr(client, "login", login_without_session)
+    server["sids"].clear()
+    with pytest.raises(QBittorrentError, match="403"):
+        client.torrents_info()
+    assert server["logins"] == 2
+
+
+def test_bad_credentials_raise(qbt):
+    url, _ = qbt
+    with pytest.raises(QBittorrentError, match="login failed"):
+        QBittorrentClient(url, "admin", "wrong").torrents_info()
+
+
+def test_poller_follows_rid_through_incremental_updates(qbt):
+    url, server = qbt
+    server["maindata"] = {
+        0: {"rid": 1, "full_update": True, "torrents": {
+            "a": {"name": "Heat", "save_path": "/media/Heat", "progress": 0.1, "category": "media"},
+            "b": {"name": "Alien", "save_path": "/media/Alien", "progress": 1.0, "category": "media"}}},
+        1: {"rid": 2, "torrents": {"a": {"progress": 0.5}}, "torrents_removed": ["b"]},
+        2: {"rid": 3},
+    }
+    poller = TorrentPoller(QBittorrentClient(url, "admin", "secret"))
+    poller.sync()
+    version = poller.version
+    assert poller.synced() and poller.find("Alien")["progress"] == 1.0
+
+    poller.sync()  # partial update: only the changed field, and a removal
+    heat = poller.find("Heat")
+    assert heat["progress"] == 0.5 and heat["save_path"] == "/media/Heat"
+    assert poller.find("Alien", timeout=0) is None
+    assert poller.version == version + 1
+
+    poller.sync()  # nothing changed
+    assert poller.version == version + 1
+    assert server["rids"] == [0, 1, 2]
+    assert poller.rid == 3
+
+
+def test_poller_full_update_replaces_the_table(qbt):
+    url, server = qbt
+    server["maindata"] = {
+        0: {"rid": 1, "full_update": True, "torrents": {"a": {"name": "Heat", "save_path": "/media/Heat"}}},
+        1: {"rid": 7, "full_update": True, "torrents": {"c": {"name": "Ran", "save_path": "/media/Ran"}}},
+    }
+    poller = TorrentPoller(QBittorrentClient(url, "admin", "secret"))
+    poller.sync()
+    poller.sync()  # qBittorrent lost our rid and sent everything again
+    assert poller.find("Heat", timeout=0) is None
+    assert poller.find("Ran")["hash"] == "c"
+    assert poller.rid == 7
@@ -0,0 +1,116 @@
+import subprocess
+import textwrap
+import requests
+import socket
+import time
+import sys
+import os
+import pytest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER = {"Cf-Access-Authenticated-User-Email": "viewer@example.com"}
+
+# app factory pointing every path create_app uses into the test's tmp dir, so both servers share one state store
+FACTORY = textwrap.dedent("""
+    import app
+    app.media_path = {base!r} + "/media_library"
+    app.progress_path = {base!r} + "/user_progress.json"
+    app.library_index_path = {base!r} + "/library_index.db"
+    app.jobs_db_path = {base!r} + "/jobs.db"
+    app.tmdb_cache_path = {base!r} + "/tmdb_cache.db"
+    app.state_db_path = {base!r} + "/state.db"
+    app.transcode_cache_path = {base!r} + "/transcode_cache"
+    app.subtitle_cache_path = {base!r} + "/subtitle_cache"
+    application = app.create_app()
+""")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# polls fn until it returns something truthy, returning it, or fails the test after timeout seconds
+def eventually(fn, timeout=15):
+    deadline = time.monotonic() + timeout
+    while True:
+        value = fn()
+        if value or time.monotonic() > deadline:
+            assert value, "timed out"
+            return value
+        time.sleep(0.1)
+
+
+# two single-worker gunicorn servers on the same state store, standing in for two workers of one server
+# (separate ports, so each request goes to a known process), returns their base urls
+@pytest.fixture
+def servers(tmp_path):
+    pytest.importorskip("gunicorn")
+    (tmp_path / "media_library").mkdir()
+    (tmp_path / "factory.py").write_text(FACTORY.format(base=str(tmp_path)))
+    env = dict(os.environ, PROGRESS_FLUSH_INTERVAL="0.2", DOWNLOAD_MONITOR_INTERVAL="0.2", JOB_MAX_ATTEMPTS="1",
+               TMDB_API_KEY="")
+    env.pop("QBITTORRENT_HOST", None)
+    procs, urls = [], []
+    for _ in range(2):
+        port = free_port()
+        procs.append(subprocess.Popen(
+            [sys.executable, "-m", "gunicorn", "--bind", f"127.0.0.1:{port}", "--workers", "1",
+             "--worker-class", "gthread", "--pythonpath", REPO, "factory:application"],
+            cwd=tmp_path, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+        urls.append(f"http://127.0.0.1:{port}")
+    try:
+        for url in urls:
+            def up(url=url):
+                try:
+                    return requests.get(f"{url}/progress_stats", headers=USER, timeout=1).ok
+                except requests.RequestException:
+                    return False
+            eventually(up, timeout=30)
+        yield urls
+    finally:
+        for proc in procs:
+            proc.terminate()
+            proc.wait()
+
+
+def progress(url, movie):
+    return requests.get(f"{url}/progress", params={"movie": movie}, headers=USER, timeout=5).json()["time"]
+
+
+def set_progress(url, movie, seconds):
+    r = requests.post(f"{url}/progress", json={"movie": movie, "time": seconds}, headers=USER, timeout=5)
+    assert r.json() == {"status": "ok"}
+
+
+def test_progress_written_by_one_worker_is_seen_by_the_other(servers):
+    a, b = servers
+    set_progress(a, "Heat", 42)
+    assert eventually(lambda: progress(b, "Heat") == 42)
+
+    set_progress(b, "Heat", 50)
+    assert eventually(lambda: progress(a, "Heat") == 50)
+
+
+def test_newest_progress_wins_across_workers(servers):
+    a, b = servers
+    set_progress(a, "Heat", 10)
+    time.sleep(0.05)
+    set_progress(b, "Heat", 20)  # newer, whichever worker flushes last
+    assert eventually(lambda: progress(a, "Heat") == 20 and progress(b, "Heat") == 20)
+    time.sleep(1)  # several flushes later it's still the newest
+    assert progress(a, "Heat") == 20 and progress(b, "Heat") == 20
+
+
+def test_download_request_state_is_shared(servers):
+    a, b = servers
+    r = requests.post(f"{a}/start_download/603", headers=USER, timeout=5)
+    assert r.status_code == 202
+
+    def state(url):
+        return requests.get(f"{url}/download_state/603", headers=USER, timeout=5).json()["state"]
+    assert eventually(lambda: state(b) != "idle")
+
+    # with no TMDb key the download job fails, both workers see the same final state
+    assert eventually(lambda: state(a) == state(b) == "failed", timeout=30)
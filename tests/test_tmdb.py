@@ -0,0 +1,115 @@
+from app.tmdb import TMDbClient, TMDbError
+from app import tmdb as tmdb_module
+from flask import Flask
+import threading
+import time
+import re
+import pytest
+
+
+# fake TMDb api: /movie/<id> answers with the id and how many times it was asked for, after delay seconds
+@pytest.fixture
+def api(fake_server):
+    url, routes = fake_server
+    server = {"hits": {}, "delay": 0, "status": 200}
+
+    def movie(h):
+        tmdb_id = int(re.fullmatch(r"/movie/(\d+)", h.path.split("?")[0]).group(1))
+        server["hits"][tmdb_id] = server["hits"].get(tmdb_id, 0) + 1
+        time.sleep(server["delay"])
+        if server["status"] != 200:
+            return server["status"], {"status_message": "down"}
+        return 200, {"id": tmdb_id, "served": server["hits"][tmdb_id]}
+
+    for tmdb_id in range(1, 10):
+        routes[("GET", f"/movie/{tmdb_id}")] = movie
+    return url, server
+
+
+def test_cached_until_the_ttl_runs_out(api, monkeypatch):
+    url, server = api
+    monkeypatch.setattr(tmdb_module, "TMDB_MOVIE_TTL", 0.3)
+    client = TMDbClient("key", base_url=url)
+    assert client.movie(1) == {"id": 1, "served": 1}
+    assert client.movie(1) == {"id": 1, "served": 1}
+    assert server["hits"][1] == 1
+
+    time.sleep(0.4)
+    assert client.movie(1) == {"id": 1, "served": 2}
+    assert client.stats()["hits"] == 1 and client.stats()["misses"] == 2
+
+
+def test_least_recently_used_entry_is_evicted(api):
+    url, server = api
+    client = TMDbClient("key", base_url=url, max_entries=2)
+    client.movie(1)
+    client.movie(2)
+    client.movie(1)  # 1 is now the most recently used
+    client.movie(3)  # evicts 2
+    assert client.stats()["size"] == 2
+
+    client.movie(1)
+    client.movie(2)
+    assert server["hits"] == {1: 1, 2: 2, 3: 1}
+
+
+def test_cache_is_persisted_without_evicted_entries(api, tmp_path):
+    url, server = api
+    app = Flask(__name__)
+    app.config['TMDB_CACHE_PATH'] = str(tmp_path / "tmdb_cache.db")
+    client = TMDbClient("key", base_url=url, max_entries=2)
+    client.init_app(app)
+    for tmdb_id in (1, 2, 3):
+        client.movie(tmdb_id)
+
+    restarted = TMDbClient("key", base_url=url, max_entries=2)
+    restarted.init_app(app)
+    restarted.movie(2)
+    restarted.movie(3)
+    restarted.movie(1)
+    assert server["hits"] == {1: 2, 2: 1, 3: 1}
+
+
+def test_concurrent_misses_share_one_request(api):
+    url, server = api
+    server["delay"] = 0.3
+    client = TMDbClient("key", base_url=url)
+    start = threading.Barrier(8)
+    results = []
+
+    def fetch():
+        start.wait()
+        results.append(client.movie(7))
+    threads = [threading.Thread(target=fetch) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert results == [{"id": 7, "served": 1}] * 8
+    assert server["hits"] == {7: 1}
+    assert client.stats()["misses"] == 1 and client.stats()["coalesced"] == 7
+
+
+def test_a_failed_request_fails_every_waiter_and_isnt_cached(api):
+    url, server = api
+    server["delay"], server["status"] = 0.3, 500
+    client = TMDbClient("key", base_url=url)
+    start = threading.Barrier(4)
+    errors = []
+
+    def fetch():
+        start.wait()
+        try:
+            client.movie(5)
+        except TMDbError as e:
+            errors.append(e)
+    threads = [threading.Thread(target=fetch) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(errors) == 4 and server["hits"] == {5: 1}
+
+    server["delay"], server["status"] = 0, 200
+    assert client.movie(5) == {"id": 5, "served": 2}